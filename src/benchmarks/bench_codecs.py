@@ -0,0 +1,81 @@
+###
+# Benchmark for content-aware tile codec selection.
+# Encodes desktop-like frames with JPEG only and with flat tiles sent as lossless WebP or PNG,
+# and compares the bytes per frame and the encode time.
+#
+# Usage (from src/): python -m benchmarks.bench_codecs [--frames N] [--quality Q]
+###
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from common.Frame_Format import CODEC_JPEG, CODEC_PNG, CODEC_WEBP
+from server.Screen_Encoder import LOSSLESS_CODEC, encode_tiles, full_frame_rects
+
+
+def text_window(width, height):
+    """An editor-like window: dark anti-aliased text on a white background"""
+    frame = np.full((height, width, 3), 255, dtype=np.uint8)
+    for line, y in enumerate(range(20, height, 20)):
+        text = f"{line:4d}  def encode_rect(frame, rect, quality, codec=CODEC_JPEG):  # x{line * 7}"
+        cv2.putText(frame, text, (8, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (30, 30, 30), 1, cv2.LINE_AA)
+    return frame
+
+
+def photo(width, height):
+    """A photo-like region: smooth gradients with fine noise"""
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:height, 0:width]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[..., 0] = (xx * 255 // width).astype(np.uint8)
+    frame[..., 1] = (yy * 255 // height).astype(np.uint8)
+    frame[..., 2] = 128
+    noise = rng.integers(-24, 24, size=frame.shape)
+    return cv2.GaussianBlur(np.clip(frame + noise, 0, 255).astype(np.uint8), (5, 5), 0)
+
+
+SCENES = {
+    'text': lambda: text_window(1920, 1080),
+    'photo': lambda: photo(1920, 1080),
+    'mixed': lambda: np.hstack([text_window(960, 1080), photo(960, 1080)]),
+}
+
+
+# (mode, lossless codec); WebP only when this OpenCV build can write it
+MODES = [('jpeg only', None)] + ([('webp tiles', CODEC_WEBP)] if LOSSLESS_CODEC == CODEC_WEBP else []) + [('png tiles', CODEC_PNG)]
+
+
+def measure(frame, frames, quality, lossless_codec):
+    """Bytes per frame, encode milliseconds per frame and the share of lossless tiles"""
+    rects = full_frame_rects(frame.shape[1], frame.shape[0])
+    tiles = encode_tiles(frame, rects, quality, lossless_codec=lossless_codec)
+    start = time.perf_counter()
+    for _ in range(frames):
+        encode_tiles(frame, rects, quality, lossless_codec=lossless_codec)
+    elapsed = (time.perf_counter() - start) / frames * 1000
+
+    size = sum(len(tile['data']) for tile in tiles)
+    area = sum(tile['w'] * tile['h'] for tile in tiles)
+    lossless_area = sum(tile['w'] * tile['h'] for tile in tiles if tile['codec'] != CODEC_JPEG)
+    return size, elapsed, lossless_area / area
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tile codec selection benchmark')
+    parser.add_argument('--frames', type=int, default=5, help='Frames to encode per measurement')
+    parser.add_argument('--quality', type=int, default=30, help='JPEG quality')
+    args = parser.parse_args()
+
+    print(f"{'scene':<8} {'mode':<14} {'KB/frame':>9} {'ms/frame':>9} {'lossless':>9}")
+    for name, make in SCENES.items():
+        frame = make()
+        for mode, lossless_codec in MODES:
+            size, elapsed, share = measure(frame, args.frames, args.quality, lossless_codec)
+            print(f"{name:<8} {mode:<14} {size / 1024:>9.1f} {elapsed:>9.1f} {share:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+###
+# Benchmark for server-side frame encoding.
+# Compares encoding a whole frame as one JPEG with encoding it as strips on ScreenGrabber's
+# thread pool, for several resolutions and thread counts.
+#
+# Usage (from src/): python -m benchmarks.bench_encode [--frames N] [--quality Q]
+###
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from server.Screen_Encoder import full_frame_rects
+from server.Capture_Backend import SyntheticBackend
+from server.Screen_Grabber import ScreenGrabber
+
+RESOLUTIONS = [(1920, 1080), (2560, 1440), (3840, 2160)]
+THREAD_COUNTS = [1, 2, 4, 8]
+
+
+def synthetic_desktop(width, height):
+    """A frame with flat UI areas, text-like detail and a photo-like gradient region"""
+    rng = np.random.default_rng(0)
+    frame = np.full((height, width, 3), 236, dtype=np.uint8)
+    frame[:40] = (32, 96, 160)
+
+    # Text-like rows of small high-contrast marks
+    for y in range(80, height // 2, 24):
+        marks = rng.integers(0, 2, size=(12, width // 2), dtype=np.uint8) * 200
+        frame[y:y + 12, 40:40 + width // 2] = 236 - marks[..., None]
+
+    # Photo-like region
+    yy, xx = np.mgrid[0:height // 2, 0:width // 2]
+    frame[height // 2:, width // 2:, 0] = (xx * 255 // (width // 2)).astype(np.uint8)
+    frame[height // 2:, width // 2:, 1] = (yy * 255 // (height // 2)).astype(np.uint8)
+    frame[height // 2:, width // 2:, 2] = rng.integers(0, 64, size=(height // 2, width // 2), dtype=np.uint8)
+    return frame
+
+
+def time_per_frame(frames, encode):
+    """Average wall time of one call to encode, in milliseconds"""
+    encode()  # warm up
+    start = time.perf_counter()
+    for _ in range(frames):
+        encode()
+    return (time.perf_counter() - start) / frames * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Frame encode benchmark')
+    parser.add_argument('--frames', type=int, default=10, help='Frames to encode per measurement')
+    parser.add_argument('--quality', type=int, default=30, help='JPEG quality')
+    args = parser.parse_args()
+
+    header = f"{'resolution':<12} {'single':>9}" + ''.join(f" {str(n) + ' thr':>9}" for n in THREAD_COUNTS)
+    print(header + "   (ms per frame)")
+
+    for width, height in RESOLUTIONS:
+        frame = synthetic_desktop(width, height)
+        rects = full_frame_rects(width, height)
+
+        single = time_per_frame(
+            args.frames, lambda: cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, args.quality])
+        )
+
+        row = f"{width}x{height:<7} {single:>9.1f}"
+        for threads in THREAD_COUNTS:
+            grabber = ScreenGrabber(SyntheticBackend(width, height, frames=[frame]), encode_threads=threads)
+
+            def encode():
+                # A fresh grab each time so the per-frame encode cache never hits
+                frame_id, grabbed = grabber.grab()
+                grabber.encode_tiles(frame_id, grabbed, rects, args.quality, lossless=False)
+
+            row += f" {time_per_frame(args.frames, encode):>9.1f}"
+            grabber.shutdown()
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
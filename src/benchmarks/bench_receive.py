@@ -0,0 +1,106 @@
+###
+# Benchmark for the client screen receive path.
+# Compares the old `data += chunk` loop with the recv_into path used by MessageSocket.recv,
+# over a local socket pair so only the receive side is measured. Memory is measured with
+# tracemalloc as the peak allocated above the starting point while each frame is received:
+# the average over all frames, and the worst frame, which for recv_into is the first one
+# growing the reusable buffer.
+#
+# Usage (from src/): python -m benchmarks.bench_receive [--frames N]
+###
+
+import argparse
+import socket
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from common.Connection import recv_exact_into
+
+FRAME_SIZES = [256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+
+def send_frames(sock, payload, frames):
+    """Write a length-prefixed frame repeatedly"""
+    for _ in range(frames):
+        sock.sendall(payload)
+
+
+def receive_legacy(sock):
+    """The original receive loop"""
+    size_bytes = sock.recv(4)
+    size = int.from_bytes(size_bytes, byteorder='big')
+
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 8192))
+        if not chunk:
+            break
+        data += chunk
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def receive_into(sock, buffers):
+    """The recv_into loop, reusing one size buffer and one frame buffer"""
+    size_buffer, frame_buffer = buffers
+    recv_exact_into(sock, memoryview(size_buffer))
+    size = int.from_bytes(size_buffer, byteorder='big')
+
+    if size > len(frame_buffer[0]):
+        frame_buffer[0] = bytearray(size)
+
+    view = memoryview(frame_buffer[0])[:size]
+    recv_exact_into(sock, view)
+    return np.frombuffer(view, dtype=np.uint8)
+
+
+def run(name, size, frames, receive):
+    """Receive frames with one implementation and report per-frame cost"""
+    server, client = socket.socketpair()
+    # Built before tracing starts, so the sender's payload isn't counted against the receiver
+    payload = size.to_bytes(4, byteorder='big') + bytes(size)
+    sender = threading.Thread(target=send_frames, args=(server, payload, frames))
+    sender.daemon = True
+    sender.start()
+
+    tracemalloc.start()
+    peaks = []
+    cpu = wall = 0.0
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        frame = receive(client)
+        wall += time.perf_counter() - wall_start
+        cpu += time.process_time() - cpu_start
+        peaks.append(tracemalloc.get_traced_memory()[1] - start)
+        del frame
+    tracemalloc.stop()
+
+    sender.join()
+    server.close()
+    client.close()
+
+    print(f"{name:<10} {size // 1024:>6} KB  "
+          f"{sum(peaks) / frames / 1024:>8.0f} KB peak/frame  "
+          f"{max(peaks) / 1024:>8.0f} KB worst  "
+          f"{cpu / frames * 1000:>8.2f} ms cpu/frame  "
+          f"{wall / frames * 1000:>8.2f} ms wall/frame")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Screen receive path benchmark')
+    parser.add_argument('--frames', type=int, default=20, help='Frames to receive per run')
+    args = parser.parse_args()
+
+    for size in FRAME_SIZES:
+        run('legacy', size, args.frames, receive_legacy)
+        buffers = (bytearray(4), [bytearray()])
+        run('recv_into', size, args.frames, lambda sock: receive_into(sock, buffers))
+
+
+if __name__ == "__main__":
+    main()
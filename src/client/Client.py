@@ -2,9 +2,14 @@ from common.util import *
 import tkinter as tk
 import common.LoggingHD as lg
 from common.Connection import Connection as ClientConnection # Import the correct class
+from common.Capabilities import describe
 from client.Client_Event_Handler import EventHandler
 import Globals as gb
 from client.Client_Command import CommandInvoker
+from client.Frame_Buffer import FrameBuffer
+from client.Frame_Decoder import DECODABLE_CODECS, choose_reduction, decode_image
+from client.Frame_Scheduler import FrameScheduler
+from client.Screen_Renderer import ScreenRenderer, scale_regions
 
 class RemoteControlClient:
     def __init__(self, host='localhost', port=5000, password='secure_password', client_id=None, root=None):
@@ -15,20 +20,33 @@ class RemoteControlClient:
         self.password = password
         self.client_id = client_id  # Used for updating connection status
         self.conn = ClientConnection(self.host, self.port, self.password, self.client_id)  # Use the correct class
+        self.conn.codecs = DECODABLE_CODECS
         self.socket = None
         self.connected = False
         self.cipher = None
 
         # Screen update settings
         self.screen_running = False     
+        self.screen_session = 0  # Bumped per connection, so screen threads of earlier ones stop
         self.screen_thread = None
         self.update_interval = 0.1  # seconds
+        self.stream_mode = True  # Let the server push frames instead of polling for each one
+        self.streaming = False  # Whether the server is pushing frames on the current connection
+        self.stream_fps = 30  # Upper bound for streaming; the server adapts below it to the link
+        self.ack_interval = 0.2  # seconds between frame acknowledgements while streaming
+        self.last_ack = 0.0
         self.is_screen_relative = False
+        self.framebuffer = FrameBuffer()  # Composites delta screen updates
         
         # Remote screen dimensions
         self.remote_width = 0
         self.remote_height = 0
         
+        # Where the remote screen is drawn on the canvas (x, y, width, height)
+        self.display_rect = None
+        self.reported_viewport = None
+        self.remote_cursor = None  # Last pointer state reported by the server
+        
         # Mouse state
         self.mouse_dragging = False
         
@@ -41,7 +59,7 @@ class RemoteControlClient:
         self.enable_controls(True)
 
         # Initialize EventHandler
-        self.event_handler = EventHandler(self.conn)
+        self.event_handler = EventHandler(self.conn, run_on_ui=lambda callback: self.root.after(0, callback))
         self.command_invoker = CommandInvoker(self.event_handler)
         
         # Auto-connect if parameters were provided
@@ -65,6 +83,7 @@ class RemoteControlClient:
             # self.h_scrollbar = ttk.Scrollbar(self.canvas_frame, orient=tk.HORIZONTAL, command=self.canvas.xview)
             # self.v_scrollbar = ttk.Scrollbar(self.canvas_frame, orient=tk.VERTICAL, command=self.canvas.yview)
             self.canvas.config(xscrollcommand=self.canvas_h_scrollbar.set, yscrollcommand=self.canvas_v_scrollbar.set)
+            self.renderer = ScreenRenderer(self.canvas)
             
             # Bind mouse events to canvas
             self.canvas.bind("<Button-1>", self.on_mouse_click)
@@ -73,6 +92,7 @@ class RemoteControlClient:
             self.canvas.bind("<ButtonRelease-1>", self.on_mouse_release)
             self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
             self.canvas.bind("<Motion>", self.on_mouse_move)
+            self.canvas.bind("<Configure>", lambda event: self.report_viewport())
             
             # Bind keyboard events to root window
             self.root.bind("<Key>", self.on_key_press)
@@ -115,6 +135,21 @@ class RemoteControlClient:
 
     def toggle_screen_relative(self):
         self.is_screen_relative = self.is_relative_var.get()
+        self.report_viewport()
+    
+    def report_viewport(self):
+        """Tell the server what size to scale the screen to; 0x0 asks for full resolution"""
+        if not self.connected:
+            return
+        
+        if self.is_screen_relative:
+            viewport = (self.canvas.winfo_width(), self.canvas.winfo_height())
+        else:
+            viewport = (0, 0)
+        
+        if viewport != self.reported_viewport:
+            self.reported_viewport = viewport
+            self.event_handler.set_viewport(*viewport)
         
     def toggle_password_visibility(self, event=None):
         """Toggle password visibility in the UI"""
@@ -123,44 +158,43 @@ class RemoteControlClient:
         else:
             self.pass_entry.config(show="•")
 
-    def _display_image(self, image):
-        """Display an image on the canvas"""
-        try:
-            tk_img = PIL.ImageTk.PhotoImage(image)
-            # self.canvas.delete("all")
-            # self.canvas.create_image(0, 0, anchor="nw", image=tk_img)
-            # self.canvas.image = tk_img  # Keep reference to prevent garbage collection
-        
-            # Update on main thread
-            self.root.after(0, lambda: self._update_canvas(tk_img, image.width, image.height))
-        except Exception as e:
-            print(f"Display error: {str(e)}")
+    def _display_image(self, image, dirty=None):
+        """Display an image on the canvas; dirty lists the regions that changed, None means all of it"""
+        # Update on main thread
+        self.root.after(0, lambda: self._update_canvas(image, dirty))
 
-    def _update_canvas(self, tk_img, width, height):
+    def _update_canvas(self, image, dirty):
         """Update the canvas with a new image (runs on main thread)"""
         try:
-            # Clear canvas
-            self.canvas.delete("all")
-            
             # Determine image position
             if self.is_screen_relative:
                 canvas_width = self.canvas.winfo_width()
                 canvas_height = self.canvas.winfo_height()
-                x_offset = max((canvas_width - width) // 2, 0)
-                y_offset = max((canvas_height - height) // 2, 0)
+                x_offset = max((canvas_width - image.width) // 2, 0)
+                y_offset = max((canvas_height - image.height) // 2, 0)
             else:
                 x_offset, y_offset = 0, 0
             
-            # Create image on canvas
-            self.canvas.create_image(x_offset, y_offset, anchor=tk.NW, image=tk_img)
-            self.canvas.image = tk_img  # Keep reference to prevent garbage collection
-            
-            # Update canvas scrollregion
-            self.canvas.config(scrollregion=(0, 0, width, height))
+            self.renderer.render(image, dirty, (x_offset, y_offset))
+            self.display_rect = (x_offset, y_offset, image.width, image.height)
+            self._update_cursor()
         
         except Exception as e:
             print(f"Canvas update error: {e}")
     
+    def _update_cursor(self):
+        """Draw the remote pointer where it is on the displayed screen (runs on main thread)"""
+        cursor = self.remote_cursor
+        if not cursor or not self.display_rect or not self.remote_width or not self.remote_height:
+            return
+        try:
+            x_offset, y_offset, width, height = self.display_rect
+            x = x_offset + cursor['x'] * width / self.remote_width
+            y = y_offset + cursor['y'] * height / self.remote_height
+            self.renderer.render_cursor(x, y, cursor.get('shape'))
+        except Exception as e:
+            print(f"Cursor update error: {e}")
+    
     def send_command(self):
         """Send a command from the command entry field"""
         command_text = self.command_entry.get().strip()
@@ -228,13 +262,20 @@ class RemoteControlClient:
                 self.connect_btn.config(text="Disconnect")
                 self.enable_controls(True)
 
-                # Start screen updates
+                # Let the server scale frames to our window before the first one is sent
+                self.reported_viewport = None
+                self.report_viewport()
+                
+                # Start screen updates; a thread left over from an earlier connection sees the
+                # session change and exits instead of reconnecting
                 self.screen_running = True
-                self.screen_thread = threading.Thread(target=self.update_screen)
+                self.screen_session += 1
+                self.screen_thread = threading.Thread(target=self.update_screen, args=(self.screen_session,))
                 self.screen_thread.daemon = True
                 self.screen_thread.start()
                 
                 self.log(f"Connected to {self.host}:{self.port}")
+                self.log(f"Negotiated {describe(self.conn.negotiated)}")
                 self.conn.update_manager_connection_status(gb.get_client_data_config_path())
             
         except Exception as e:
@@ -242,63 +283,194 @@ class RemoteControlClient:
             self.log(f"Connection error: {e}")
             tk.messagebox.showerror("Connection Error", e)
 
-    def update_screen(self):
-        """Continuously update the screen with data from the server"""
-        while self.screen_running and self.connected:
-            start_time = time.time()
-            screen_data = self.event_handler.receive_screen()
-            if not screen_data:
-                break
+    def screen_session_active(self, session):
+        """Whether the screen thread of this session should keep going"""
+        return self.screen_running and self.connected and self.screen_session == session
+    
+    def update_screen(self, session):
+        """Receive screen updates for as long as we are connected, reconnecting when the link drops"""
+        while self.screen_session_active(session):
+            self.receive_screen_updates(session)
             
-            # Update remote screen dimensions
-            self.remote_width = screen_data['width']
-            self.remote_height = screen_data['height']
+            # A user disconnect clears screen_running or starts a new session; anything else is a lost link
+            if not self.screen_session_active(session) or not self.reconnect(session):
+                break
+    
+    def reconnect(self, session):
+        """Reconnect with backoff after the link dropped; the stream is then resumed as it was"""
+        self.log("Connection lost, reconnecting...")
+        self.root.after(0, lambda: self.status_var.set("Reconnecting..."))
+        
+        # Offer the server our last frame, so a resumed session can carry on with deltas
+        self.conn.resume_frame_id = self.framebuffer.frame_id
+        
+        def failed(error, delay):
+            self.log(f"Reconnect failed: {error}; retrying in {delay:.1f} s")
+        
+        if not self.conn.reconnect(lambda: self.screen_session_active(session), failed):
+            return False
+        
+        self.root.after(0, lambda: self.status_var.set("Connected"))
+        if self.conn.resumed:
+            # The server kept our viewport and stream settings, and streaming already continues
+            self.log(f"Resumed session with {self.conn.host}:{self.conn.port}")
+            return True
+        
+        # A new session starts without our viewport; the stream settings are sent again by
+        # receive_screen_updates
+        self.log(f"Reconnected to {self.conn.host}:{self.conn.port}")
+        self.reported_viewport = None
+        self.root.after(0, self.report_viewport)
+        return True
+    
+    def receive_screen_updates(self, session):
+        """Receive screen updates from the server and hand them to the frame scheduler until the link drops"""
+        # A resumed session continues from the frame we already have
+        if not self.conn.resumed:
+            self.framebuffer.reset()
+        
+        # Subscribe to a pushed stream when the server supports it, otherwise poll per frame
+        streaming = self.streaming = self.stream_mode and self.event_handler.start_stream(self.stream_fps)
+        receive = self.event_handler.receive_frame if streaming else self.event_handler.receive_screen
+        self.last_ack = 0.0
+        
+        # Decoding and displaying run on the scheduler's thread, so the next frame is received meanwhile
+        interval = 1.0 / self.stream_fps if streaming else self.update_interval
+        scheduler = FrameScheduler(
+            self._decode_frame,
+            lambda screen_data, image: self._present_frame(screen_data, image, streaming),
+            interval, on_stats=self._show_frame_stats
+        )
+        scheduler.start()
+        
+        try:
+            next_request = time.perf_counter()
+            reply_pending = False  # A polled reply is still due after the pointer state that preceded it
+            while self.screen_session_active(session):
+                if not streaming and not reply_pending:
+                    # Poll on a fixed cadence rather than sleeping a fixed time after each frame
+                    delay = next_request - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_request = max(next_request + interval, time.perf_counter())
+                
+                screen_data = self.event_handler.receive_frame() if reply_pending else receive()
+                reply_pending = False
+                if not screen_data:
+                    break
+                
+                if screen_data.get('type') == 'stream_stats':
+                    self._show_stream_stats(screen_data)
+                    continue
+                if screen_data.get('type') == 'cursor':
+                    # Pointer moves come separately from frames and are drawn as an overlay
+                    self.remote_cursor = screen_data
+                    self.root.after(0, self._update_cursor)
+                    reply_pending = not streaming
+                    continue
+                if screen_data.get('type') == 'unchanged':
+                    # We already show the current screen; nothing to decode or redraw
+                    continue
+                
+                # Update remote screen dimensions
+                if (screen_data['width'], screen_data['height']) != (self.remote_width, self.remote_height):
+                    self.remote_width = screen_data['width']
+                    self.remote_height = screen_data['height']
+                    self.root.after(0, lambda: self.screen_size_label.config(
+                        text=f"Remote Screen: {screen_data['width']}x{screen_data['height']}"
+                    ))
+                
+                scheduler.submit(screen_data)
+        finally:
+            scheduler.stop()
 
-            # Update remote screen dimensions
-            self.root.after(0, lambda: self.screen_size_label.config(
-                text=f"Remote Screen: {screen_data['width']}x{screen_data['height']}"
-            ))
-            
-            # Decode image
-            image_data = base64.b64decode(screen_data['image'])
-            
-            image_tensor = torch.tensor(list(image_data), dtype=torch.uint8).cuda()
-            
-            # Transfer the tensor back to CPU and convert to numpy array
-            image_array = image_tensor.detach().cpu().numpy()
-            image_array = np.frombuffer(image_data, dtype=np.uint8)
-            image = cv2.imdecode(image_array, cv2.IMREAD_COLOR_RGB)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            
-            # Convert to PIL Image
-            pil_img = PIL.Image.fromarray(image)
-            
-            # Resize image to fit canvas while maintaining aspect ratio
-            if self.is_screen_relative:
-                canvas_width = self.canvas.winfo_width()
-                canvas_height = self.canvas.winfo_height()
-                scale = min(canvas_width / self.remote_width, canvas_height / self.remote_height)
-                new_width = int(self.remote_width * scale)
-                new_height = int(self.remote_height * scale)
-                pil_img = pil_img.resize((new_width, new_height), PIL.Image.LANCZOS)
-            
-            # Display the resized image
-            self._display_image(pil_img)
-            
-            # Calculate time to process and adjust delay
-            process_time = time.time() - start_time
-            delay = max(0.05, self.update_interval - process_time)
-            time.sleep(delay)
+    def _present_frame(self, screen_data, image, streaming):
+        """Scale a decoded frame for the canvas and display it; called by the frame scheduler"""
+        # Regions composited since the last presented frame; full frames replace everything
+        dirty = self.framebuffer.take_dirty() if 'tiles' in screen_data else None
+        
+        # Convert to PIL Image
+        pil_img = PIL.Image.fromarray(image)
+        
+        # Resize image to fit canvas while maintaining aspect ratio
+        if self.is_screen_relative:
+            canvas_width = self.canvas.winfo_width()
+            canvas_height = self.canvas.winfo_height()
+            scale = min(canvas_width / self.remote_width, canvas_height / self.remote_height)
+            new_width = int(self.remote_width * scale)
+            new_height = int(self.remote_height * scale)
+        else:
+            # The server may have sent a downscaled frame; show it at remote size
+            new_width, new_height = self.remote_width, self.remote_height
+        if pil_img.size != (new_width, new_height):
+            # Frames arrive already scaled close to this size, so a cheap filter is enough
+            dirty = scale_regions(dirty, pil_img.size, (new_width, new_height))
+            pil_img = pil_img.resize((new_width, new_height), PIL.Image.BILINEAR)
+        
+        # Display the resized image
+        self._display_image(pil_img, dirty)
+        
+        # Pushed frames are paced by the server, which adapts to the acknowledged frames
+        now = time.time()
+        if streaming and 'frame_id' in screen_data and now - self.last_ack >= self.ack_interval:
+            self.event_handler.send_ack(screen_data['frame_id'])
+            self.last_ack = now
+
+    def _show_frame_stats(self, stats):
+        """Show the achieved display rate, jitter and dropped frames in the status bar"""
+        text = f"Display: {stats['fps']} fps, jitter {stats['jitter_ms']} ms, dropped {stats['dropped']}"
+        self.root.after(0, lambda: self.frame_stats_label.config(text=text))
+
+    def _show_stream_stats(self, stats):
+        """Show the server's current stream decisions in the status bar"""
+        text = f"Stream: {stats['fps']} fps, Q{stats['quality']}, {int(stats['scale'] * 100)}%"
+        if stats.get('rtt_ms') is not None:
+            text += f", RTT {stats['rtt_ms']} ms"
+        if stats.get('kbps') is not None:
+            text += f", {stats['kbps']} kbps"
+        if stats.get('capture_ms') is not None:
+            text += f", capture {stats['capture_ms']} ms"
+        if stats.get('input_ms') is not None:
+            text += f", input {stats['input_ms']} ms"
+        self.root.after(0, lambda: self.stream_stats_label.config(text=text))
+
+    def _decode_frame(self, screen_data):
+        """Decode a screen update into an RGB array, at reduced size when the canvas is smaller"""
+        reduction = 1
+        if self.is_screen_relative:
+            reduction = choose_reduction(
+                screen_data.get('frame_width', self.remote_width),
+                screen_data.get('frame_height', self.remote_height),
+                self.canvas.winfo_width(), self.canvas.winfo_height()
+            )
+        
+        if 'tiles' not in screen_data:
+            # Full frame from a server without delta support
+            return decode_image(base64.b64decode(screen_data['image']), reduction)
+        
+        # Delta update: composite the changed tiles into the local framebuffer; after a decode
+        # size change the untouched regions are only a rescaled copy, so ask for a full refresh
+        if self.framebuffer.set_reduction(reduction):
+            self.event_handler.copy_rects = reduction == 1
+            self.event_handler.request_keyframe()
+        return self.framebuffer.apply(screen_data)
 
     def disconnect(self):
         """Disconnect from the server"""
         self.screen_running = False  # Stop screen updates
-        self.connection.disconnect()
+        self.screen_session += 1
+        self.event_handler.input_queue.clear()
+        if self.streaming:
+            # Stop the server pushing frames nobody reads while the connection closes
+            self.event_handler.stop_stream()
+            self.streaming = False
+        self.conn.disconnect()
         self.connected = False
         self.status_var.set("Disconnected")
         self.connect_btn.config(text="Connect")
         self.enable_controls(False)
-        self.canvas.delete("all")
+        self.renderer.clear()
+        self.remote_cursor = None
         self.screen_size_label.config(text="Remote Screen: Not connected")
         self.log("Disconnected from server")
     
@@ -334,6 +506,15 @@ class RemoteControlClient:
         """Map canvas coordinates to remote screen coordinates"""
         view_x = self.canvas.canvasx(x)
         view_y = self.canvas.canvasy(y)
+        
+        # Undo the offset and scaling the screen was drawn with
+        if self.display_rect and self.remote_width and self.remote_height:
+            x_offset, y_offset, width, height = self.display_rect
+            view_x = (view_x - x_offset) * self.remote_width / width
+            view_y = (view_y - y_offset) * self.remote_height / height
+            view_x = min(max(view_x, 0), self.remote_width - 1)
+            view_y = min(max(view_y, 0), self.remote_height - 1)
+        
         return int(view_x), int(view_y)
 
     def on_mouse_move(self, event):
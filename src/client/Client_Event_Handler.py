@@ -1,11 +1,27 @@
 import json
 import os
+import threading
 from tkinter import filedialog, simpledialog, messagebox
+from common.Frame_Format import is_binary_frame, unpack_frame, tiles_from_json
+from common.Connection import BULK_CHUNK_SIZE, CHANNEL_BULK, CHANNEL_SCREEN
+from client.Input_Queue import InputQueue
 
 class EventHandler:
-    def __init__(self, connection):
+    def __init__(self, connection, run_on_ui=None):
         self.connection = connection
         self.mouse_dragging = False
+        
+        # File transfers run in the background and report back through the UI thread
+        self.run_on_ui = run_on_ui or (lambda callback: callback())
+        self.transfer_thread = None
+        
+        # Mouse and keyboard events are coalesced and batched instead of sent one by one
+        self.input_queue = InputQueue(self._send_input)
+        self.input_queue.start()
+        
+        # Accept scrolled and moved regions as copies of the previous frame; only exact when
+        # frames are decoded at full size
+        self.copy_rects = True
 
     def on_mouse_move(self, x, y):
         """Handle mouse movement event"""                
@@ -16,7 +32,7 @@ class EventHandler:
             'y': y,
             'button': 'left'
         }
-        self._send_command(cmd)
+        self.input_queue.put(cmd)
 
     def on_mouse_click(self, x, y):
         """Handle mouse click event"""
@@ -27,7 +43,7 @@ class EventHandler:
             'y': y,
             'button': 'left'
         }
-        self._send_command(cmd)
+        self.input_queue.put(cmd)
 
     def on_mouse_double_click(self, x, y):
         """Handle mouse double click event"""
@@ -38,7 +54,7 @@ class EventHandler:
             'y': y,
             'button': 'left'
         }
-        self._send_command(cmd)
+        self.input_queue.put(cmd)
 
     def on_mouse_drag(self, x, y):
         """Handle mouse drag event"""
@@ -50,7 +66,7 @@ class EventHandler:
             'y': y,
             'button': 'left'
         }
-        self._send_command(cmd)
+        self.input_queue.put(cmd)
 
     def on_mouse_release(self):
         """Handle mouse release event"""
@@ -63,7 +79,7 @@ class EventHandler:
             'type': 'scroll',
             'amount': amount
         }
-        self._send_command(cmd)
+        self.input_queue.put(cmd)
 
     def on_key_press(self, key, modifiers):
         """Handle key press event"""
@@ -76,7 +92,7 @@ class EventHandler:
             'keys': modifiers + [key.lower()] if modifiers else None,
             'key': key.lower() if not modifiers else None
         }
-        self._send_command(cmd)
+        self.input_queue.put(cmd)
 
     def send_text(self, text):
         """Send text to the remote server"""
@@ -88,10 +104,13 @@ class EventHandler:
             'type': 'write',
             'text': text
         }
-        self._send_command(cmd)
+        self.input_queue.put(cmd)
 
     def upload_file(self):
         """Upload a file to the remote server"""
+        if self._transfer_running():
+            return
+        
         # Open file dialog
         file_path = filedialog.askopenfilename(title="Select File to Upload")
         if not file_path:
@@ -106,6 +125,11 @@ class EventHandler:
         if not remote_path:
             return
         
+        self._start_transfer(self._upload, file_path, remote_path)
+
+    def _upload(self, file_path, remote_path):
+        """Send a file on the bulk channel (runs on the transfer thread)"""
+        messages = self.connection.messages
         try:
             # Get file size
             file_size = os.path.getsize(file_path)
@@ -118,28 +142,28 @@ class EventHandler:
             }
             self._send_command(cmd)
             
-            # Read and send file data
+            # Read and send file data; control and screen messages go out between the chunks
             with open(file_path, 'rb') as file:
-                chunk_size = 4096
+                chunk_size = BULK_CHUNK_SIZE if messages.channels else 4096
                 while chunk := file.read(chunk_size):
-                    encrypted_chunk = self.connection.cipher.encrypt(chunk)
-                    self.connection.socket.send(encrypted_chunk)
+                    messages.send(chunk, channel=CHANNEL_BULK)
             
             # Receive confirmation
-            response_data = self.connection.socket.recv(1024)
-            decrypted = self.connection.cipher.decrypt(response_data).decode()
-            response = json.loads(decrypted)
+            response = messages.recv_json() or {}
             
             if response.get('status') == 'success':
-                messagebox.showinfo("Success", "File uploaded successfully")
+                self._show(messagebox.showinfo, "Success", "File uploaded successfully")
             else:
-                messagebox.showerror("Error", response.get('message', 'Unknown error'))
+                self._show(messagebox.showerror, "Error", response.get('message', 'Unknown error'))
         
         except Exception as e:
-            messagebox.showerror("Upload Error", str(e))
+            self._show(messagebox.showerror, "Upload Error", str(e))
 
     def download_file(self):
         """Download a file from the remote server"""
+        if self._transfer_running():
+            return
+        
         # Ask for remote path
         remote_path = simpledialog.askstring("Remote Path", "Enter remote file path to download:")
         if not remote_path:
@@ -153,6 +177,11 @@ class EventHandler:
         if not local_path:
             return
         
+        self._start_transfer(self._download, remote_path, local_path)
+
+    def _download(self, remote_path, local_path):
+        """Receive a file from the bulk channel (runs on the transfer thread)"""
+        messages = self.connection.messages
         try:
             # Send file download command
             cmd = {
@@ -162,70 +191,134 @@ class EventHandler:
             self._send_command(cmd)
             
             # Receive file size
-            size_data = self.connection.socket.recv(1024)
-            decrypted = self.connection.cipher.decrypt(size_data).decode()
-            size_info = json.loads(decrypted)
+            size_info = messages.recv_json()
+            if size_info is None:
+                raise ConnectionError("Connection closed")
             
             if 'error' in size_info:
-                messagebox.showerror("Error", size_info['error'])
+                self._show(messagebox.showerror, "Error", size_info['error'])
                 return
             
             file_size = size_info['size']
             
-            # Receive file data
-            with open(local_path, 'wb') as file:
-                received = 0
-                while received < file_size:
-                    chunk = self.connection.socket.recv(4096)
-                    if not chunk:
-                        break
-                    decrypted_chunk = self.connection.cipher.decrypt(chunk)
-                    file.write(decrypted_chunk)
-                    received += len(decrypted_chunk)
+            # Receive file data. If the file can't be written the rest is still read and dropped,
+            # since unread chunks would fill the bulk inbox and stall the screen thread.
+            error = None
+            file = None
+            try:
+                file = open(local_path, 'wb')
+            except OSError as e:
+                error = e
+            received = 0
+            while received < file_size:
+                chunk = messages.recv(channel=CHANNEL_BULK)
+                if chunk is None:
+                    break
+                if error is None:
+                    try:
+                        file.write(chunk)
+                    except OSError as e:
+                        error = e
+                received += len(chunk)
+            if file:
+                file.close()
+            if error:
+                raise error
             
-            messagebox.showinfo("Success", "File downloaded successfully")
+            self._show(messagebox.showinfo, "Success", "File downloaded successfully")
         
         except Exception as e:
-            messagebox.showerror("Download Error", str(e))
+            self._show(messagebox.showerror, "Download Error", str(e))
+
+    def _transfer_running(self):
+        """Refuse to start a second transfer while one is still running"""
+        if self.transfer_thread and self.transfer_thread.is_alive():
+            messagebox.showerror("Transfer in Progress", "Wait for the current file transfer to finish")
+            return True
+        return False
+
+    def _start_transfer(self, target, *args):
+        """Run a transfer in the background, so the screen and input carry on meanwhile"""
+        self.transfer_thread = threading.Thread(target=target, args=args)
+        self.transfer_thread.daemon = True
+        self.transfer_thread.start()
+
+    def _show(self, dialog, title, message):
+        """Show a message box from the transfer thread"""
+        self.run_on_ui(lambda: dialog(title, message))
+
+    def start_stream(self, fps, timeout=2.0):
+        """Ask the server to push screen frames; returns False if it doesn't start streaming"""
+        cmd = {'action': 'stream', 'fps': fps, 'delta': True, 'copy': self.copy_rects}
+        self._send_command(cmd)
+        
+        # Servers without stream support ignore the request, so wait for the first screen message
+        return self.connection.messages.poll(timeout, framed=True, channel=CHANNEL_SCREEN)
+
+    def stop_stream(self):
+        """Ask the server to stop pushing screen frames"""
+        cmd = {'action': 'stream', 'fps': 0}
+        self._send_command(cmd)
+
+    def send_ack(self, frame_id):
+        """Tell the server a streamed frame has been displayed"""
+        cmd = {'action': 'ack', 'frame_id': frame_id}
+        self._send_command(cmd)
+
+    def set_viewport(self, width, height):
+        """Ask the server to scale frames to fit this size; 0x0 means full resolution"""
+        cmd = {'action': 'viewport', 'width': width, 'height': height}
+        self._send_command(cmd)
+
+    def request_keyframe(self):
+        """Ask the server to resend the whole screen with the next frame"""
+        cmd = {'action': 'keyframe', 'copy': self.copy_rects}
+        self._send_command(cmd)
 
     def receive_screen(self):
         """Request and receive screen updates from the server"""
         try:
-            # Request screen update
-            cmd = {'action': 'screen'}
+            # Request screen update; servers that support it reply with changed tiles only
+            cmd = {'action': 'screen', 'delta': True, 'copy': self.copy_rects}
             self._send_command(cmd)
-            
-            # Receive data size
-            size_bytes = self.connection.socket.recv(4)
-            if not size_bytes:
+        except Exception as e:
+            print(f"Screen request error: {str(e)}")
+            return None
+        
+        return self.receive_frame()
+
+    def receive_frame(self):
+        """Receive the next screen frame, either requested or pushed by the server"""
+        try:
+            # Screen messages are size-prefixed even from servers without message framing
+            decrypted = self.connection.messages.recv(framed=True, channel=CHANNEL_SCREEN)
+            if decrypted is None:
                 return None
             
-            size = int.from_bytes(size_bytes, byteorder='big')
+            # Parse screen data
+            if is_binary_frame(decrypted):
+                return unpack_frame(decrypted)
             
-            # Receive screen data
-            data = b''
-            while len(data) < size:
-                chunk = self.connection.socket.recv(min(size - len(data), 8192))
-                if not chunk:
-                    break
-                data += chunk
-            
-            if not data:
-                return None
-            
-            # Decrypt and parse screen data
-            decrypted = self.connection.cipher.decrypt(data).decode()
-            screen_data = json.loads(decrypted)
+            screen_data = json.loads(decrypted.decode())
+            if 'tiles' in screen_data:
+                screen_data['tiles'] = tiles_from_json(screen_data['tiles'])
             return screen_data
         
         except Exception as e:
             print(f"Screen receive error: {str(e)}")
             return None
 
+    def _send_input(self, events):
+        """Send queued input events, as one batch when the server takes batches"""
+        if len(events) > 1 and self.connection.input_batch:
+            self._send_command({'action': 'input_batch', 'events': events})
+        else:
+            for cmd in events:
+                self._send_command(cmd)
+
     def _send_command(self, cmd):
         """Send a command to the server"""
         try:
-            encrypted = self.connection.cipher.encrypt(json.dumps(cmd).encode())
-            self.connection.socket.send(encrypted)
+            self.connection.messages.send_json(cmd)
         except Exception as e:
             print(f"Error sending command: {str(e)}")
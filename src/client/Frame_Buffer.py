@@ -0,0 +1,77 @@
+import cv2
+import numpy as np
+from client.Frame_Decoder import decode_image
+from common.Frame_Format import CODEC_COPY, COPY_SOURCE
+
+class FrameBuffer:
+    """Client-side copy of the remote screen that delta tiles are composited into"""
+    def __init__(self):
+        self.image = None
+        self.reduction = 1  # The buffer holds the remote frame at 1/reduction size
+        self.dirty = None  # Regions (x, y, w, h) changed since take_dirty(); None means all of it
+        self.frame_id = None  # Server frame id of the last update composited, for resuming a session
+
+    def reset(self):
+        """Drop the current contents, e.g. after reconnecting"""
+        self.image = None
+        self.dirty = None
+        self.frame_id = None
+
+    def take_dirty(self):
+        """Return the regions changed since the last call (None for the whole frame) and start over"""
+        dirty, self.dirty = self.dirty, []
+        return dirty
+
+    def set_reduction(self, reduction):
+        """Switch the decode size; returns True if the buffer was rescaled and needs a full refresh"""
+        if reduction == self.reduction:
+            return False
+
+        if self.image is not None:
+            # Keep showing a rescaled copy until the refreshed tiles arrive
+            old_height, old_width = self.image.shape[:2]
+            width = -(-old_width * self.reduction // reduction)
+            height = -(-old_height * self.reduction // reduction)
+            self.image = cv2.resize(self.image, (width, height), interpolation=cv2.INTER_AREA)
+
+        self.reduction = reduction
+        self.dirty = None
+        return self.image is not None
+
+    def apply(self, screen_data):
+        """Decode and composite the tiles of a screen update and return the full frame"""
+        reduction = self.reduction
+        width = -(-screen_data['frame_width'] // reduction)
+        height = -(-screen_data['frame_height'] // reduction)
+
+        # (Re)allocate on the first frame or when the remote resolution changes
+        if self.image is None or self.image.shape[:2] != (height, width):
+            self.image = np.zeros((height, width, 3), dtype=np.uint8)
+            self.dirty = None
+
+        # Copies read the previous frame, so take all their sources before anything is written
+        sources = []
+        for tile in screen_data['tiles']:
+            if tile['codec'] != CODEC_COPY:
+                continue
+            src_x, src_y = COPY_SOURCE.unpack(tile['data'])
+            src_x, src_y = src_x // reduction, src_y // reduction
+            sources.append(self.image[src_y:src_y + -(-tile['h'] // reduction),
+                                      src_x:src_x + -(-tile['w'] // reduction)].copy())
+        sources = iter(sources)
+
+        for tile in screen_data['tiles']:
+            if tile['codec'] == CODEC_COPY:
+                tile_image = next(sources)
+            else:
+                tile_image = decode_image(tile['data'], reduction)
+
+            # Tile origins are multiples of the tile size, so they divide evenly by the reduction
+            x, y = tile['x'] // reduction, tile['y'] // reduction
+            target = self.image[y:y + tile_image.shape[0], x:x + tile_image.shape[1]]
+            target[...] = tile_image[:target.shape[0], :target.shape[1]]
+            if self.dirty is not None:
+                self.dirty.append((x, y, target.shape[1], target.shape[0]))
+
+        self.frame_id = screen_data.get('frame_id')
+        return self.image
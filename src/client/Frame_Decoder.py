@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+
+# imdecode flags for each supported reduction factor; JPEG is decoded directly at the smaller size
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# Tile codec names this client can display, for capability negotiation; OpenCV builds include
+# WebP for reading and writing alike
+DECODABLE_CODECS = ['jpeg', 'png'] + (['webp'] if cv2.haveImageWriter('.webp') else []) + ['copy']
+
+
+def choose_reduction(remote_width, remote_height, view_width, view_height):
+    """Largest decode reduction that still gives at least as many pixels as the view can show"""
+    if remote_width <= 0 or remote_height <= 0 or view_width <= 1 or view_height <= 1:
+        return 1
+
+    fit = min(view_width / remote_width, view_height / remote_height)
+    for reduction in (8, 4, 2):
+        if fit <= 1 / reduction:
+            return reduction
+    return 1
+
+
+def decode_image(data, reduction=1):
+    """Decode encoded image bytes into an RGB array, optionally at 1/2, 1/4 or 1/8 size
+
+    The server hands its RGB capture to imencode as-is, so the default BGR decode already
+    yields RGB: the decoder's own colour conversion is the only one on this path.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    image = cv2.imdecode(buffer, REDUCED_DECODE_FLAGS[reduction])
+    if image is None:
+        raise ValueError("Could not decode screen image")
+    return image
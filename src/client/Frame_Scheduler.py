@@ -0,0 +1,173 @@
+import statistics
+import threading
+import time
+from collections import deque
+
+from common.Frame_Format import CODEC_COPY
+
+
+def prune_superseded_tiles(frames):
+    """Drop tiles that a later frame in the batch overwrites completely
+
+    Returns the frames with pruned tile lists (frames left with nothing to decode are removed)
+    and the number of frames that were skipped entirely. Full frames without tiles supersede
+    everything before them.
+    """
+    # Only the frames after the last full (tile-less) frame matter
+    start = 0
+    for index, frame in enumerate(frames):
+        if 'tiles' not in frame:
+            start = index
+    skipped = start
+    frames = frames[start:]
+
+    kept = []
+    covered = {}  # (frame size, tile row y) -> [(x0, x1, y1)] spans of later tiles
+    for frame in reversed(frames):
+        if 'tiles' not in frame:
+            kept.append(frame)
+            continue
+
+        size = (frame['frame_width'], frame['frame_height'])
+        tiles = []
+        for tile in frame['tiles']:
+            x0, x1, y1 = tile['x'], tile['x'] + tile['w'], tile['y'] + tile['h']
+            spans = covered.get((size, tile['y']), ())
+            if not any(sx0 <= x0 and sx1 >= x1 and sy1 >= y1 for sx0, sx1, sy1 in spans):
+                tiles.append(tile)
+
+        # Remember this frame's tiles for the earlier frames in the batch; copies read the
+        # frame before them, so nothing earlier may be pruned once a frame has any
+        if any(tile['codec'] == CODEC_COPY for tile in frame['tiles']):
+            covered = {}
+        else:
+            for tile in frame['tiles']:
+                covered.setdefault((size, tile['y']), []).append((tile['x'], tile['x'] + tile['w'], tile['y'] + tile['h']))
+
+        if tiles or frame is frames[-1]:
+            pruned = dict(frame)
+            pruned['tiles'] = tiles
+            kept.append(pruned)
+        else:
+            skipped += 1
+
+    kept.reverse()
+    return kept, skipped
+
+
+class FrameScheduler:
+    """Decode and present received frames on their own thread, paced to presentation deadlines
+
+    The receive loop only queues frames, so receiving the next frame overlaps with decoding and
+    displaying the current one. Tiles that a newer queued frame overwrites are never decoded, and
+    a decoded frame that is overtaken by a newer one before its deadline is not presented.
+    """
+    def __init__(self, decode, present, interval, on_stats=None, stats_interval=1.0):
+        self.decode = decode  # screen_data -> RGB image
+        self.present = present  # (screen_data, image) -> None
+        self.interval = interval  # target seconds between presented frames
+        self.on_stats = on_stats
+        self.stats_interval = stats_interval
+
+        self.running = False
+        self.thread = None
+        self._pending = []
+        self._condition = threading.Condition()
+
+        # Session statistics
+        self.received = 0
+        self.presented = 0
+        self.dropped = 0
+        self._present_times = deque(maxlen=120)
+        self._last_stats = 0.0
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=1.0):
+        """Stop and wait for the frame being decoded, so the framebuffer is settled afterwards"""
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def submit(self, screen_data):
+        """Queue a received frame; called from the receive loop"""
+        with self._condition:
+            self._pending.append(screen_data)
+            self.received += 1
+            self._condition.notify()
+
+    def _take_pending(self, timeout=None):
+        """Wait for queued frames and take all of them"""
+        with self._condition:
+            if not self._pending and self.running:
+                self._condition.wait(timeout)
+            frames, self._pending = self._pending, []
+            return frames
+
+    def _run(self):
+        deadline = time.perf_counter()
+        frames = []
+        image = None
+        last = None
+
+        while self.running:
+            frames += self._take_pending(None if not frames else 0)
+            if not frames:
+                continue
+
+            batch, skipped = prune_superseded_tiles(frames)
+            self.dropped += skipped
+            frames = []
+            try:
+                for screen_data in batch:
+                    image = self.decode(screen_data)
+                    last = screen_data
+            except Exception as e:
+                print(f"Decode error: {str(e)}")
+                continue
+
+            # Hold the frame until its deadline; if a newer one arrives first, show that instead
+            now = time.perf_counter()
+            if now < deadline:
+                frames = self._take_pending(deadline - now)
+                if frames:
+                    self.dropped += 1
+                    continue
+
+            try:
+                self.present(last, image)
+            except Exception as e:
+                print(f"Present error: {str(e)}")
+
+            now = time.perf_counter()
+            self.presented += 1
+            self._present_times.append(now)
+
+            # Aim for a steady cadence, but don't try to catch up after a stall
+            deadline = max(deadline + self.interval, now + self.interval * 0.5)
+            self._report_stats(now)
+
+    def stats(self):
+        """Achieved fps, frame-to-frame jitter (ms) and frames dropped this session"""
+        times = list(self._present_times)
+        intervals = [b - a for a, b in zip(times, times[1:])]
+        fps = len(intervals) / (times[-1] - times[0]) if len(intervals) > 1 and times[-1] > times[0] else 0.0
+        jitter = statistics.pstdev(intervals) * 1000 if len(intervals) > 1 else 0.0
+        return {
+            'fps': round(fps, 1),
+            'jitter_ms': round(jitter, 1),
+            'dropped': self.dropped,
+            'presented': self.presented,
+            'received': self.received
+        }
+
+    def _report_stats(self, now):
+        if self.on_stats and now - self._last_stats >= self.stats_interval:
+            self._last_stats = now
+            self.on_stats(self.stats())
@@ -0,0 +1,87 @@
+import threading
+import time
+
+# Events that only say where the pointer is now; a newer one of the same kind supersedes them
+MOTION_TYPES = ('move', 'drag')
+
+
+def coalesce(pending, cmd):
+    """Fold cmd into the last pending event if it supersedes it; returns False if it must be appended
+
+    Only the last event is ever touched, so clicks and key presses keep their place between moves.
+    """
+    if not pending or cmd.get('action') != 'mouse':
+        return False
+    last = pending[-1]
+    if last.get('action') != 'mouse' or last['type'] != cmd['type']:
+        return False
+
+    if cmd['type'] in MOTION_TYPES and last.get('button') == cmd.get('button'):
+        pending[-1] = cmd
+        return True
+    if cmd['type'] == 'scroll':
+        pending[-1] = dict(last, amount=last['amount'] + cmd['amount'])
+        return True
+    return False
+
+
+class InputQueue:
+    """Collect mouse and keyboard commands and send them in batches from a background thread
+
+    Consecutive moves (or drags, or scrolls) that are still waiting are folded into one, so a
+    1000 Hz mouse costs at most one message per window. The first event after a quiet spell and
+    every click or key press are flushed right away; only motion that follows closely behind
+    waits for the window to pass. Events are always sent in the order they were put.
+    """
+    def __init__(self, send, window=0.008):
+        self.send = send  # called with a list of commands from the queue's thread
+        self.window = window  # seconds, the shortest time between two flushes of motion
+        self.pending = []
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.last_flush = 0.0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.ready.set()
+
+    def put(self, cmd):
+        """Queue a command; safe to call from any thread"""
+        with self.lock:
+            if not coalesce(self.pending, cmd):
+                self.pending.append(cmd)
+        self.ready.set()
+
+    def clear(self):
+        """Drop anything not sent yet, e.g. after disconnecting"""
+        with self.lock:
+            self.pending = []
+
+    def _run(self):
+        while self.running:
+            self.ready.wait()
+            self.ready.clear()
+
+            # Hold motion back until the window has passed, but never a click or key press
+            with self.lock:
+                urgent = any(cmd.get('type') not in MOTION_TYPES for cmd in self.pending)
+            delay = self.last_flush + self.window - time.perf_counter()
+            if delay > 0 and not urgent:
+                time.sleep(delay)
+
+            with self.lock:
+                events, self.pending = self.pending, []
+            if events:
+                self.last_flush = time.perf_counter()
+                try:
+                    self.send(events)
+                except Exception as e:
+                    print(f"Error sending input: {str(e)}")
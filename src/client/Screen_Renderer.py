@@ -0,0 +1,122 @@
+import tkinter as tk
+
+import PIL.Image
+import PIL.ImageTk
+
+# Beyond this many dirty regions a single full paste is cheaper than one copy per region
+MAX_DIRTY_REGIONS = 32
+
+# Tk cursor names for the pointer shapes the server reports
+TK_CURSORS = {
+    'arrow': 'arrow',
+    'ibeam': 'xterm',
+    'wait': 'watch',
+    'progress': 'watch',
+    'crosshair': 'crosshair',
+    'size_nwse': 'sizing',
+    'size_nesw': 'sizing',
+    'size_we': 'sb_h_double_arrow',
+    'size_ns': 'sb_v_double_arrow',
+    'size_all': 'fleur',
+    'no': 'X_cursor',
+    'hand': 'hand2',
+}
+
+# Outline of the remote pointer overlay, relative to its hot spot
+CURSOR_OUTLINE = [(0, 0), (0, 16), (4, 12), (7, 18), (9, 17), (6, 11), (11, 11)]
+
+
+def scale_regions(regions, source_size, target_size):
+    """Map (x, y, w, h) regions onto a resized image, padded for the filter's reach and clipped"""
+    if regions is None:
+        return None
+
+    sx = target_size[0] / source_size[0]
+    sy = target_size[1] / source_size[1]
+    scaled = []
+    for x, y, w, h in regions:
+        # Bilinear filtering blends neighbouring pixels, so grow each region by a pixel
+        x0 = max(0, int(x * sx) - 1)
+        y0 = max(0, int(y * sy) - 1)
+        x1 = min(target_size[0], int((x + w) * sx) + 2)
+        y1 = min(target_size[1], int((y + h) * sy) + 2)
+        if x1 > x0 and y1 > y0:
+            scaled.append((x0, y0, x1 - x0, y1 - y0))
+    return scaled
+
+
+def ppm_data(image):
+    """Raw binary PPM bytes of a PIL image, a format Tk's photo put reads natively"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return b'P6 %d %d 255\n' % image.size + image.tobytes()
+
+
+class ScreenRenderer:
+    """Draw the remote screen into one canvas image item backed by one PhotoImage
+
+    The PhotoImage is only recreated when the displayed size changes; otherwise updated regions
+    are written into it in place, so Tk does not allocate a new image or canvas item per frame
+    or per region.
+    All methods must run on the Tk main thread.
+    """
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.photo = None
+        self.item = None
+        self.size = None
+        self.offset = (0, 0)
+        self.cursor_item = None
+        self.cursor_shape = None
+
+    def render(self, image, dirty=None, offset=(0, 0)):
+        """Show a PIL image at offset; dirty lists the changed (x, y, w, h) regions, None means all of it"""
+        if self.photo is None or image.size != self.size:
+            # First frame or new geometry: the only time a PhotoImage is created
+            self.photo = PIL.ImageTk.PhotoImage(image)
+            self.size = image.size
+            if self.item is None:
+                self.item = self.canvas.create_image(*offset, anchor=tk.NW, image=self.photo)
+                self.offset = offset
+            else:
+                self.canvas.itemconfig(self.item, image=self.photo)
+            self.canvas.config(scrollregion=(0, 0, image.width, image.height))
+        elif dirty is None or len(dirty) > MAX_DIRTY_REGIONS:
+            self.photo.paste(image)
+        else:
+            for x, y, w, h in dirty:
+                # Write the region into the persistent photo as raw PPM data, without a Tk image per region
+                self.photo.tk.call(str(self.photo), 'put', ppm_data(image.crop((x, y, x + w, y + h))),
+                                   '-format', 'ppm', '-to', x, y)
+
+        if offset != self.offset:
+            self.canvas.coords(self.item, *offset)
+            self.offset = offset
+
+    def render_cursor(self, x, y, shape=None):
+        """Draw the remote pointer at canvas position (x, y) and show its shape as the local cursor"""
+        points = [coord for px, py in CURSOR_OUTLINE for coord in (x + px, y + py)]
+        if self.cursor_item is None:
+            self.cursor_item = self.canvas.create_polygon(points, fill='black', outline='white')
+        else:
+            self.canvas.coords(self.cursor_item, *points)
+        self.canvas.itemconfig(self.cursor_item, state=tk.HIDDEN if shape == 'hidden' else tk.NORMAL)
+        self.canvas.tag_raise(self.cursor_item)
+
+        if shape != self.cursor_shape:
+            self.canvas.config(cursor=TK_CURSORS.get(shape, ''))
+            self.cursor_shape = shape
+
+    def clear(self):
+        """Remove the image and pointer, e.g. after disconnecting"""
+        if self.item is not None:
+            self.canvas.delete(self.item)
+        if self.cursor_item is not None:
+            self.canvas.delete(self.cursor_item)
+            self.canvas.config(cursor='')
+        self.cursor_item = None
+        self.cursor_shape = None
+        self.photo = None
+        self.item = None
+        self.size = None
+        self.offset = (0, 0)
@@ -0,0 +1,90 @@
+from common.Session_Cipher import SESSION_CIPHERS
+
+# Version of the hello document; peers use the lower of their two versions
+PROTOCOL_VERSION = 1
+
+# Tile codec names, in the order the server prefers them
+CODECS = ['webp', 'png', 'jpeg', 'copy']
+
+# Optional behaviour a session only uses when both sides have it
+FEATURES = ['channels', 'heartbeat', 'input_batch', 'resume', 'cursor']
+
+# Categories where one value is chosen, and the value used when the peer shares none
+CHOICES = {
+    'frame_formats': ('frame_format', 'json'),
+    'compression': ('compression', 'none'),
+    'framing': ('framing', 'token'),
+    'ciphers': ('cipher', None),
+}
+
+
+def local_capabilities(codecs=CODECS, features=FEATURES):
+    """This build's hello: what it supports in each category, most preferred first"""
+    return {
+        'version': PROTOCOL_VERSION,
+        'frame_formats': ['binary', 'json'],
+        'codecs': list(codecs),
+        'compression': ['none'],
+        'framing': ['length', 'token'],
+        'ciphers': list(SESSION_CIPHERS),
+        'features': list(features),
+    }
+
+
+def negotiate_capabilities(local, offered):
+    """Pick the best common set from our hello and the peer's, in our order of preference
+
+    Returns the negotiated dict both sides keep for the session: the protocol version, one
+    frame format, compression, framing and cipher (None keeps Fernet), and the lists of codecs
+    and features both support.
+    """
+    negotiated = {'version': min(local['version'], offered.get('version', 0))}
+    for category, (key, default) in CHOICES.items():
+        common = [value for value in local[category] if value in (offered.get(category) or [])]
+        negotiated[key] = common[0] if common else default
+
+    # Everything after authentication depends on framing; without it there is no cipher or channel
+    features = [feature for feature in local['features'] if feature in (offered.get('features') or [])]
+    if negotiated['framing'] != 'length':
+        negotiated['cipher'] = None
+        features = [feature for feature in features if feature not in ('channels', 'heartbeat', 'resume')]
+    if 'channels' not in features:
+        features = [feature for feature in features if feature not in ('heartbeat', 'resume')]
+    negotiated['features'] = features
+    negotiated['codecs'] = [codec for codec in local['codecs'] if codec in (offered.get('codecs') or [])]
+    return negotiated
+
+
+def legacy_hello(message):
+    """Read the separate negotiation fields of peers that predate the hello as a hello
+
+    Older builds decoded every image codec and were sent pointer messages regardless.
+    """
+    framed = message.get('framing') == 'length'
+    features = ['cursor']
+    if framed and message.get('channels') is True:
+        features.append('channels')
+        if message.get('heartbeat'):
+            # Resumption arrived alongside heartbeats; a ticket nobody uses does no harm
+            features += ['heartbeat', 'resume']
+    if message.get('input_batch') is True:
+        features.append('input_batch')
+
+    frame_formats = message.get('frame_formats') or [message.get('frame_format', 'json')]
+    cipher = message.get('cipher')
+    return {
+        'version': 0,
+        'frame_formats': frame_formats,
+        'codecs': CODECS,
+        'compression': ['none'],
+        'framing': ['length'] if framed else ['token'],
+        'ciphers': message.get('ciphers') or ([cipher] if cipher else []),
+        'features': features,
+    }
+
+
+def describe(negotiated):
+    """One-line summary of a negotiated session, for logs"""
+    features = '+'.join(negotiated['features']) or 'no features'
+    return (f"v{negotiated['version']}, {negotiated['frame_format']}, {negotiated['framing']} framing, "
+            f"{negotiated['cipher'] or 'fernet'}, {'/'.join(negotiated['codecs'])}, {features}")
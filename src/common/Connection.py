@@ -1,9 +1,432 @@
+import asyncio
 import socket
 import json
+import threading
 import base64
 from cryptography.fernet import Fernet
 from datetime import datetime
 import os
+import random
+import select
+import time
+from collections import deque
+from common.Session_Cipher import SessionCipher, derive_session_key, handshake_nonce
+from common.Capabilities import CODECS, legacy_hello, local_capabilities, negotiate_capabilities
+
+# Logical channels multiplexed over one connection, highest priority first
+CHANNEL_CONTROL = 0  # Commands, input and replies
+CHANNEL_SCREEN = 1  # Frames, cursor and stream messages
+CHANNEL_BULK = 2  # File data
+CHANNEL_HEARTBEAT = 3  # Empty keepalive messages, consumed by the connection layer itself
+CHANNEL_PRIORITY = [CHANNEL_CONTROL, CHANNEL_SCREEN, CHANNEL_BULK]
+
+# Peers with channels send a heartbeat this often and give up on a peer silent for the timeout
+HEARTBEAT_INTERVAL = 2.0
+HEARTBEAT_TIMEOUT = 6.0
+
+# Largest authentication message accepted; it is read before the peer has proven anything
+AUTH_MAX_SIZE = 64 * 1024
+
+# File data is sent in chunks of this size on the bulk channel, so other channels can cut in
+BULK_CHUNK_SIZE = 16 * 1024
+BULK_INBOX_LIMIT = 64  # File chunks queued for the bulk reader before the socket stops being read
+BULK_UNSENT_LIMIT = 2 * BULK_CHUNK_SIZE  # Unsent bytes the kernel may hold once channels are on
+
+def recv_exact_into(sock, view):
+    """Fill a writable memoryview from the socket; returns False if the peer closed first"""
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if not count:
+            return False
+        received += count
+    return True
+
+def limit_unsent(sock):
+    """Keep the kernel from holding more than BULK_UNSENT_LIMIT of unsent data for the socket
+
+    Otherwise a file transfer fills the whole send buffer, often megabytes, and anything sent
+    after it waits for all of that to go out. With TCP_NOTSENT_LOWAT sends block, and the
+    socket doesn't poll writable, until the unsent data drops below the mark; data already in
+    flight isn't counted, so throughput doesn't suffer. Where the option is missing the send
+    buffer is made small instead, which limits data in flight too.
+    """
+    try:
+        if hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, BULK_UNSENT_LIMIT)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * BULK_UNSENT_LIMIT)
+    except OSError:
+        pass
+
+class MessageSocket:
+    """Encrypted messages over a socket, each sent as a 4-byte big-endian length and the ciphertext
+
+    Partial reads and several messages arriving in one read are handled, so messages can be
+    sent back to back from any thread. The cipher is the password's Fernet or a per-connection
+    SessionCipher. Peers that did not negotiate framing send bare Fernet tokens and are read
+    with one recv() per message, as before.
+
+    With channels negotiated, each message starts with its channel id inside the encryption.
+    recv(channel=...) then returns only that channel's messages: whichever thread is reading
+    queues other channels' messages for their own readers, so screen frames, replies and file
+    data can be read from different threads. Bulk sends wait for pending control and screen
+    sends, and limit_unsent() keeps the kernel from queueing more than a couple of chunks
+    ahead of them, so a file transfer delays them by a few chunks rather than a send buffer.
+    """
+    def __init__(self, sock, cipher, framed=True, channels=False):
+        self.socket = sock
+        self.cipher = cipher
+        self.framed = framed
+        self.channels = channels
+        if channels:
+            limit_unsent(sock)
+        self.send_lock = threading.Lock()  # Keeps concurrent senders from interleaving
+
+        # Senders waiting ahead of bulk data
+        self._send_cond = threading.Condition()
+        self._urgent = 0
+
+        # Messages read for channels other than the reader's, and whether a thread is reading
+        self._recv_cond = threading.Condition()
+        self._inbox = {channel: deque() for channel in CHANNEL_PRIORITY}
+        self._reading = False
+        self._closed = False
+        self.last_received = time.monotonic()  # Any data received counts as a sign of life, even part of a message
+
+        # Reusable receive buffers, grown to the largest message seen
+        self._size_buffer = bytearray(4)
+        self._recv_buffer = bytearray()
+
+    def send(self, payload, framed=None, channel=CHANNEL_CONTROL):
+        """Encrypt and send one message; returns the bytes put on the wire"""
+        if framed is None:
+            framed = self.framed
+        if not self.channels:
+            return self._send(payload, framed)
+
+        payload = bytes([channel]) + payload
+        if channel == CHANNEL_BULK:
+            with self._send_cond:
+                self._send_cond.wait_for(lambda: not self._urgent)
+            return self._send(payload, framed)
+
+        with self._send_cond:
+            self._urgent += 1
+        try:
+            return self._send(payload, framed)
+        finally:
+            with self._send_cond:
+                self._urgent -= 1
+                self._send_cond.notify_all()
+
+    def _send(self, payload, framed):
+        # Encrypt under the lock too: session ciphers number their messages and need them in order
+        with self.send_lock:
+            return self._send_locked(payload, framed)
+
+    def _send_locked(self, payload, framed):
+        encrypted = self.cipher.encrypt(payload)
+        if framed:
+            encrypted = len(encrypted).to_bytes(4, byteorder='big') + encrypted
+        self.socket.sendall(encrypted)
+        return len(encrypted)
+
+    def send_heartbeat(self):
+        """Send a heartbeat unless another message is going out right now, which does as well"""
+        if not self.send_lock.acquire(blocking=False):
+            return False
+        try:
+            self._send_locked(bytes([CHANNEL_HEARTBEAT]), True)
+            return True
+        finally:
+            self.send_lock.release()
+
+    def close(self):
+        """Shut the socket down, so threads blocked reading or writing it return"""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        with self._recv_cond:
+            self._closed = True
+            self._recv_cond.notify_all()
+
+    def send_json(self, message, framed=None, channel=CHANNEL_CONTROL):
+        return self.send(json.dumps(message).encode(), framed, channel)
+
+    def recv(self, framed=None, channel=CHANNEL_CONTROL):
+        """Receive and decrypt one message; returns None if the peer closed the connection"""
+        if framed is None:
+            framed = self.framed
+        if not self.channels:
+            # A message poll() already read comes first
+            if self._inbox[channel]:
+                return self._inbox[channel].popleft()
+            return self._recv(framed)
+
+        with self._recv_cond:
+            while True:
+                if self._inbox[channel]:
+                    # A reader may be waiting for room in this inbox
+                    self._recv_cond.notify_all()
+                    return self._inbox[channel].popleft()
+                if self._closed:
+                    return None
+                if not self._reading:
+                    self._reading = True
+                    break
+                self._recv_cond.wait()
+
+        # This thread reads for everyone until a message for its own channel arrives
+        try:
+            while True:
+                message = self._recv(True)
+                if message is None:
+                    with self._recv_cond:
+                        self._closed = True
+                    return None
+                if message[0] == channel:
+                    return message[1:]
+                if message[0] == CHANNEL_HEARTBEAT:
+                    continue
+                with self._recv_cond:
+                    if not self._queue(message):
+                        return None
+        finally:
+            with self._recv_cond:
+                self._reading = False
+                self._recv_cond.notify_all()
+
+    def poll(self, timeout, framed=None, channel=CHANNEL_CONTROL):
+        """Wait up to timeout seconds for a message on channel, leaving it for recv(); returns whether one came
+
+        Messages for other channels that arrive meanwhile are queued for their readers as usual.
+        Without channels, whatever message comes first counts and is kept for recv(channel=channel).
+        """
+        if framed is None:
+            framed = self.framed
+        deadline = time.monotonic() + timeout
+        with self._recv_cond:
+            while True:
+                if self._inbox[channel]:
+                    return True
+                if self._closed:
+                    return False
+                if not self._reading:
+                    self._reading = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._recv_cond.wait(remaining)
+
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([self.socket], [], [], remaining)[0]:
+                    return False
+                message = self._recv(True if self.channels else framed)
+                with self._recv_cond:
+                    if message is None:
+                        self._closed = True
+                        return False
+                    if not self.channels:
+                        self._inbox[channel].append(message)
+                        return True
+                    if message[0] == CHANNEL_HEARTBEAT:
+                        continue
+                    if not self._queue(message):
+                        return False
+                    if message[0] == channel:
+                        return True
+        finally:
+            with self._recv_cond:
+                self._reading = False
+                self._recv_cond.notify_all()
+
+    def _queue(self, message):
+        """Queue a message for its channel's reader, with _recv_cond held; returns False if the socket closed meanwhile
+
+        File data waits for room in the bulk inbox first. Meanwhile nobody reads the socket, so a
+        download outrunning the disk slows the sender through TCP instead of filling memory.
+        """
+        if message[0] == CHANNEL_BULK:
+            self._recv_cond.wait_for(lambda: len(self._inbox[CHANNEL_BULK]) < BULK_INBOX_LIMIT or self._closed)
+            if self._closed:
+                return False
+        self._inbox[message[0]].append(message[1:])
+        self._recv_cond.notify_all()
+        return True
+
+    def _recv(self, framed):
+        if not framed:
+            data = self.socket.recv(4096)
+            if not data:
+                return None
+            self.last_received = time.monotonic()
+            return self.cipher.decrypt(data)
+
+        if not self._recv_exact_into(memoryview(self._size_buffer)):
+            return None
+        size = int.from_bytes(self._size_buffer, byteorder='big')
+        if size > len(self._recv_buffer):
+            self._recv_buffer = bytearray(size)
+
+        # Read straight into the reusable buffer; Fernet only accepts bytes, so it needs one copy
+        view = memoryview(self._recv_buffer)[:size]
+        if not self._recv_exact_into(view):
+            return None
+        return self.cipher.decrypt(view if getattr(self.cipher, 'accepts_views', False) else bytes(view))
+
+    def _recv_exact_into(self, view):
+        """recv_exact_into that notes every chunk as it arrives, so a large frame that takes longer
+        than the heartbeat timeout to come in over a slow link doesn't count as silence"""
+        received = 0
+        while received < len(view):
+            count = self.socket.recv_into(view[received:])
+            if not count:
+                return False
+            received += count
+            self.last_received = time.monotonic()
+        return True
+
+    def recv_json(self, framed=None, channel=CHANNEL_CONTROL):
+        payload = self.recv(framed, channel)
+        return json.loads(payload.decode()) if payload is not None else None
+
+class Heartbeat:
+    """Send heartbeats on a MessageSocket and shut it down once the peer has gone silent
+
+    Every chunk of data received counts as a sign of life, heartbeats or not, so a frame that is
+    still coming in over a slow link keeps the connection up. A dead peer makes the
+    threads reading the socket get None, the same as for a closed connection. This relies on
+    some thread reading the socket, as the client's screen thread always does.
+    """
+    def __init__(self, messages, interval=HEARTBEAT_INTERVAL, timeout=HEARTBEAT_TIMEOUT):
+        self.messages = messages
+        self.interval = interval
+        self.timeout = timeout
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            if time.monotonic() - self.messages.last_received > self.timeout:
+                self.messages.close()
+                return
+            try:
+                self.messages.send_heartbeat()
+            except OSError:
+                self.messages.close()
+                return
+
+def backoff_delays(initial=0.5, maximum=30.0, factor=2.0):
+    """Delays between reconnect attempts: exponential, capped, and jittered so a fleet doesn't retry in step"""
+    delay = initial
+    while True:
+        yield delay * random.uniform(0.5, 1.0)
+        delay = min(delay * factor, maximum)
+
+class AsyncMessageStream:
+    """MessageSocket's wire format over an asyncio stream, for the server's event loop
+
+    send() only queues the message on the transport and never blocks; callers that produce a
+    lot of data await drain() so a slow peer holds back its own session and nobody else's.
+    With channels, bulk data goes through send_bulk(), which keeps at most about one chunk of
+    it queued on the transport, and limit_unsent() bounds what the kernel holds beyond that,
+    so control and screen messages queued later are not stuck behind a file.
+    Must only be used from the event loop that owns the stream.
+    """
+    def __init__(self, reader, writer, cipher, framed=True, channels=False):
+        self.reader = reader
+        self.writer = writer
+        self.cipher = cipher
+        self.framed = framed
+        self.channels = channels
+        if channels:
+            writer.transport.set_write_buffer_limits(high=BULK_CHUNK_SIZE)
+            limit_unsent(writer.get_extra_info('socket'))
+
+    @property
+    def buffered(self):
+        """Bytes queued on the transport that the kernel has not accepted yet"""
+        return self.writer.transport.get_write_buffer_size()
+
+    def send(self, payload, framed=None, channel=CHANNEL_CONTROL):
+        """Encrypt and queue one message; returns the bytes put on the wire"""
+        if framed is None:
+            framed = self.framed
+        if self.channels:
+            payload = bytes([channel]) + payload
+        encrypted = self.cipher.encrypt(payload)
+        if framed:
+            encrypted = len(encrypted).to_bytes(4, byteorder='big') + encrypted
+        self.writer.write(encrypted)
+        return len(encrypted)
+
+    def send_json(self, message, framed=None, channel=CHANNEL_CONTROL):
+        return self.send(json.dumps(message).encode(), framed, channel)
+
+    def send_heartbeat(self):
+        """Queue a heartbeat unless other data is still waiting to go out, which does as well"""
+        if self.buffered:
+            return False
+        self.send(b'', channel=CHANNEL_HEARTBEAT)
+        return True
+
+    async def send_bulk(self, payload):
+        """Queue one chunk of file data once the transport has drained"""
+        size = self.send(payload, channel=CHANNEL_BULK)
+        await self.drain()
+        return size
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def recv(self, framed=None):
+        """Receive and decrypt one message; returns None if the peer closed the connection"""
+        message = await self.recv_message(framed)
+        return message[1] if message is not None else None
+
+    async def recv_message(self, framed=None):
+        """Receive one message as (channel, payload); without channels everything is control"""
+        if framed is None:
+            framed = self.framed
+        if not framed:
+            data = await self.reader.read(4096)
+            return (CHANNEL_CONTROL, self.cipher.decrypt(data)) if data else None
+
+        try:
+            size = int.from_bytes(await self.reader.readexactly(4), byteorder='big')
+            data = await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            return None
+        payload = self.cipher.decrypt(data)
+        if self.channels and payload[0] == CHANNEL_HEARTBEAT:
+            return CHANNEL_HEARTBEAT, b''
+        if self.channels:
+            return payload[0], payload[1:]
+        return CHANNEL_CONTROL, payload
+
+    async def recv_json(self, framed=None):
+        payload = await self.recv(framed)
+        return json.loads(payload.decode()) if payload is not None else None
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        """Drop the connection at once, without waiting for queued data to reach a dead peer"""
+        self.writer.transport.abort()
 
 class Connection:
     def __init__(self, host, port, password, client_id=None):
@@ -15,14 +438,31 @@ class Connection:
         self.socket = None
         self.cipher = None
         self.connected = False
+        self.frame_format = 'json'  # Negotiated with the server during authentication
+        self.messages = None  # MessageSocket for everything after authentication
+        self.session_cipher = None  # Name of the negotiated AEAD cipher, None when staying on Fernet
+        self.input_batch = False  # Whether the server takes several input events in one command
+        self.heartbeat_interval = HEARTBEAT_INTERVAL  # seconds between our heartbeats
+        self.heartbeat_timeout = HEARTBEAT_TIMEOUT  # seconds of silence before the server counts as gone
+        self.heartbeat = None  # Runs while connected to servers that send heartbeats
+        self.server_heartbeat = None  # seconds between the server's heartbeats, None if it sends none
+        self.reconnect_initial = 0.5  # seconds before the first reconnect attempt
+        self.reconnect_max = 30.0  # longest wait between reconnect attempts
+        self.ticket = None  # Lets a reconnect resume the session, if the server issued one
+        self.resume_frame_id = None  # Last frame we have, so a resumed session can continue with deltas
+        self.resumed = False  # Whether the current connection resumed the previous session
+        self.codecs = CODECS  # Tile codecs we can decode, offered in the hello
+        self.framed_auth = True  # Length-prefix the authentication exchange; off for servers that predate it
+        self.negotiated = None  # Capabilities agreed with the server, see common.Capabilities
 
     def fix_host(self, host):
         if host.lower() == "localhost":
             return "127.0.0.1"
+        return host
             
 
-    def connect(self):
-        """Connect to the remote server"""
+    def connect(self, resume=False):
+        """Connect to the remote server; resume asks to continue the previous session with its ticket"""
         try:
             self.host = self.fix_host(self.host)
             # Generate encryption key from password
@@ -30,27 +470,45 @@ class Connection:
             self.cipher = Fernet(key)
             
             # Create socket and connect
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(5)  # 5 second timeout for connection
-            # print (self.host)
-            # print (self.port)
-            self.socket.connect((self.host, self.port))
+            self.open_socket()
             
             # Authenticate
-            if not self.authenticate():
+            framed_auth = self.framed_auth
+            authenticated = self.authenticate(resume)
+            if not authenticated and framed_auth and not self.framed_auth:
+                # The server predates framed authentication and could not read us; log in again its way
+                self.open_socket()
+                authenticated = self.authenticate(resume)
+            if not authenticated:
                 self.disconnect()
                 raise Exception("Authentication failed")
             
             self.socket.settimeout(None)  # Remove timeout after successful connection
             self.connected = True
+            self.start_heartbeat()
             return True
         
         except Exception as e:
             self.disconnect()
             raise e
 
+    def open_socket(self):
+        """Open a fresh TCP connection to the server, closing any previous one"""
+        if self.socket:
+            self.socket.close()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.settimeout(5)  # 5 second timeout for connection
+        self.socket.connect((self.host, self.port))
+
     def disconnect(self):
         """Disconnect from the server"""
+        if self.heartbeat:
+            self.heartbeat.stop()
+            self.heartbeat = None
+        if self.messages:
+            # Shut the socket down first, so threads blocked reading it return now rather than
+            # failing whenever the next message would have arrived
+            self.messages.close()
         if self.socket:
             try:
                 self.socket.close()
@@ -59,23 +517,126 @@ class Connection:
             self.socket = None
         self.connected = False
 
-    def authenticate(self):
+    def authenticate(self, resume=False):
         """Authenticate with the server"""
         try:
-            auth_data = {'password': self.password}
+            # Offer everything we support in the hello; the separate fields are still sent for
+            # servers that predate it, and older servers ignore whatever they don't know
+            client_nonce = handshake_nonce()
+            hello = local_capabilities(self.codecs)
+            auth_data = {
+                'password': self.password,
+                'hello': hello,
+                'frame_formats': hello['frame_formats'],
+                'framing': 'length',
+                'channels': True,
+                'heartbeat': self.heartbeat_interval,
+                'ciphers': hello['ciphers'],
+                'nonce': base64.b64encode(client_nonce).decode()
+            }
+            if resume and self.ticket:
+                auth_data['resume'] = self.ticket
+                auth_data['frame_id'] = self.resume_frame_id
             encrypted = self.cipher.encrypt(json.dumps(auth_data).encode())
-            self.socket.send(encrypted)
-            
-            # Receive response
-            response_data = self.socket.recv(1024)
+            if self.framed_auth:
+                # Length-prefixed like every later message, so the reply is read exactly and
+                # whatever the server sends right after it stays in the socket for MessageSocket
+                self.socket.sendall(len(encrypted).to_bytes(4, byteorder='big') + encrypted)
+                response_data = self.recv_auth_reply()
+                if response_data is None:
+                    return False
+            else:
+                self.socket.send(encrypted)
+                response_data = self.socket.recv(4096)
             decrypted = self.cipher.decrypt(response_data).decode()
             response = json.loads(decrypted)
             
+            # Servers without the hello are read from their separate fields; those that don't
+            # negotiate at all only speak JSON and read one bare token per recv()
+            self.negotiated = response.get('hello') or negotiate_capabilities(hello, legacy_hello(response))
+            features = self.negotiated['features']
+            self.frame_format = self.negotiated['frame_format']
+            framed = self.negotiated['framing'] == 'length'
+            
+            # Everything after authentication is encrypted with a key derived for this connection
+            cipher = self.cipher
+            self.session_cipher = self.negotiated['cipher']
+            if self.session_cipher:
+                server_nonce = base64.b64decode(response['nonce'])
+                key = derive_session_key(self.password, client_nonce, server_nonce)
+                cipher = SessionCipher.for_client(self.session_cipher, key)
+            # Older servers ignore unknown actions, so input is only batched when they say they take it
+            self.input_batch = 'input_batch' in features
+            self.server_heartbeat = response.get('heartbeat') if 'heartbeat' in features else None
+            
+            # Each login brings a new ticket; a resumed session keeps its settings and last frame
+            self.ticket = response.get('ticket')
+            self.resumed = response.get('resumed') is True
+            
+            # Channels let screen frames, replies and file data be read by different threads
+            channels = 'channels' in features
+            self.messages = MessageSocket(self.socket, cipher, framed, channels)
+            
             return response.get('status') == 'success'
         
         except Exception:
             return False
 
+    def recv_auth_reply(self):
+        """Read the server's length-prefixed authentication reply; None if there is none
+
+        Servers that predate framed authentication answer with a bare Fernet token, which never
+        starts with a zero byte the way a length prefix does. Such a reply is read the old way,
+        and framed_auth is turned off for the logins that follow.
+        """
+        head = bytearray(4)
+        if not recv_exact_into(self.socket, memoryview(head)):
+            return None
+        if head[0] != 0:
+            self.framed_auth = False
+            return bytes(head) + self.socket.recv(4096)
+        size = int.from_bytes(head, byteorder='big')
+        if size > AUTH_MAX_SIZE:
+            return None
+        reply = bytearray(size)
+        if not recv_exact_into(self.socket, memoryview(reply)):
+            return None
+        return bytes(reply)
+
+    def start_heartbeat(self):
+        """Exchange heartbeats with servers that send them, so a dead link is noticed within the timeout"""
+        interval = self.server_heartbeat
+        if not interval or not self.messages.channels:
+            return
+        # Allow for a few of the server's heartbeats going missing before giving up
+        timeout = max(self.heartbeat_timeout, 3 * interval)
+        self.heartbeat = Heartbeat(self.messages, self.heartbeat_interval, timeout)
+        self.heartbeat.start()
+
+    def reconnect(self, should_continue, on_failure=None):
+        """Connect again after the link dropped, backing off exponentially between attempts
+
+        Gives up when should_continue() turns False; on_failure is called with each error and
+        the delay before the next attempt. Returns whether the connection is back.
+        """
+        self.disconnect()
+        for delay in backoff_delays(self.reconnect_initial, self.reconnect_max):
+            if not should_continue():
+                return False
+            try:
+                self.connect(resume=True)
+                return True
+            except Exception as e:
+                if on_failure:
+                    on_failure(e, delay)
+            # Sleep in short steps so giving up doesn't wait out a long delay
+            deadline = time.monotonic() + delay
+            while time.monotonic() < deadline:
+                if not should_continue():
+                    return False
+                time.sleep(min(0.1, deadline - time.monotonic()))
+        return False
+
     def update_manager_connection_status(self, config_path):
         """Update the connection status in the manager if client_id is set"""
         if not self.client_id:
@@ -0,0 +1,103 @@
+import base64
+import struct
+
+# Compact binary screen frame, sent instead of JSON + base64 once both peers agree on it.
+#
+# Frame header (network byte order):
+#   magic 'RF', format version, default codec,
+#   remote screen width/height, encoded frame width/height,
+#   frame id, capture timestamp (seconds since the epoch), tile count
+# Each tile then follows as a tile header and its encoded bytes:
+#   x, y, w, h, codec, payload length
+MAGIC = b'RF'
+VERSION = 1
+
+# Tile codecs; lossless ones carry text and flat UI regions, JPEG carries photographic ones
+CODEC_JPEG = 1
+CODEC_PNG = 2
+CODEC_WEBP = 3  # lossless WebP
+CODEC_COPY = 4  # no image: the payload is the (x, y) to copy the tile from in the previous frame
+
+COPY_SOURCE = struct.Struct('!HH')
+
+FRAME_HEADER = struct.Struct('!2sBBHHHHIdH')
+TILE_HEADER = struct.Struct('!HHHHBI')
+
+
+def is_binary_frame(payload):
+    """Tell a binary frame apart from a JSON message"""
+    return payload[:2] == MAGIC
+
+
+def pack_frame(frame):
+    """Serialize a frame dict into a single binary message"""
+    parts = [FRAME_HEADER.pack(
+        MAGIC,
+        VERSION,
+        frame.get('codec', CODEC_JPEG),
+        frame['width'],
+        frame['height'],
+        frame['frame_width'],
+        frame['frame_height'],
+        frame['frame_id'],
+        frame['timestamp'],
+        len(frame['tiles'])
+    )]
+    for tile in frame['tiles']:
+        data = tile['data']
+        parts.append(TILE_HEADER.pack(tile['x'], tile['y'], tile['w'], tile['h'], tile['codec'], len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def unpack_frame(payload):
+    """Parse a binary message into a frame dict; tile data are views into payload, not copies"""
+    view = memoryview(payload)
+    (magic, version, codec, width, height, frame_width, frame_height,
+     frame_id, timestamp, tile_count) = FRAME_HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Unsupported frame format version {version}")
+
+    tiles = []
+    offset = FRAME_HEADER.size
+    for _ in range(tile_count):
+        x, y, w, h, tile_codec, length = TILE_HEADER.unpack_from(view, offset)
+        offset += TILE_HEADER.size
+        tiles.append({
+            'x': x,
+            'y': y,
+            'w': w,
+            'h': h,
+            'codec': tile_codec,
+            'data': view[offset:offset + length]
+        })
+        offset += length
+
+    return {
+        'width': width,
+        'height': height,
+        'frame_width': frame_width,
+        'frame_height': frame_height,
+        'frame_id': frame_id,
+        'timestamp': timestamp,
+        'codec': codec,
+        'tiles': tiles
+    }
+
+
+def tiles_to_json(tiles):
+    """Convert tiles to the JSON form used with peers that don't speak the binary format"""
+    return [
+        {'x': t['x'], 'y': t['y'], 'w': t['w'], 'h': t['h'], 'codec': t['codec'],
+         'image': base64.b64encode(t['data']).decode()}
+        for t in tiles
+    ]
+
+
+def tiles_from_json(tiles):
+    """Convert JSON tiles back into the same shape unpack_frame produces"""
+    return [
+        {'x': t['x'], 'y': t['y'], 'w': t['w'], 'h': t['h'], 'codec': t.get('codec', CODEC_JPEG),
+         'data': base64.b64decode(t['image'])}
+        for t in tiles
+    ]
@@ -0,0 +1,79 @@
+import os
+import struct
+import threading
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# AEAD ciphers for the session after authentication, most preferred first
+SESSION_CIPHERS = {
+    'aes-gcm': AESGCM,
+    'chacha20-poly1305': ChaCha20Poly1305,
+}
+
+# Length of the random nonce each side contributes to the key derivation
+HANDSHAKE_NONCE_SIZE = 16
+
+# Each direction has its own nonce prefix, so the two never reuse a nonce under the shared key
+CLIENT_TO_SERVER = b'\x00\x00\x00\x01'
+SERVER_TO_CLIENT = b'\x00\x00\x00\x02'
+
+COUNTER = struct.Struct('!Q')
+
+
+def handshake_nonce():
+    """Random contribution of one side to the session key"""
+    return os.urandom(HANDSHAKE_NONCE_SIZE)
+
+
+def derive_session_key(password, client_nonce, server_nonce):
+    """Derive a fresh 256-bit key for one connection from the password and both handshake nonces"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=client_nonce + server_nonce, info=b'RAIRU session key')
+    return hkdf.derive(password.encode())
+
+
+class SessionCipher:
+    """AEAD encryption of raw binary messages, with a drop-in encrypt/decrypt interface for Fernet
+
+    A message is an 8-byte counter followed by the ciphertext and its 16-byte tag; the nonce is
+    the sender's direction prefix plus the counter. Unlike Fernet there is no base64, padding or
+    timestamp, and the receiver rejects any counter it has already seen, so messages cannot be
+    replayed or reordered. Messages must therefore be sent in the order they were encrypted.
+    """
+    accepts_views = True  # decrypt() works on memoryviews, so receive buffers need no copy
+
+    def __init__(self, name, key, send_prefix, recv_prefix):
+        self.name = name
+        self.aead = SESSION_CIPHERS[name](key)
+        self.send_prefix = send_prefix
+        self.recv_prefix = recv_prefix
+        self.send_counter = 0
+        self.recv_counter = -1
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_client(cls, name, key):
+        return cls(name, key, CLIENT_TO_SERVER, SERVER_TO_CLIENT)
+
+    @classmethod
+    def for_server(cls, name, key):
+        return cls(name, key, SERVER_TO_CLIENT, CLIENT_TO_SERVER)
+
+    def encrypt(self, payload):
+        """Encrypt a bytes-like payload"""
+        with self.lock:
+            counter = self.send_counter
+            self.send_counter += 1
+        header = COUNTER.pack(counter)
+        return header + self.aead.encrypt(self.send_prefix + header, payload, None)
+
+    def decrypt(self, data):
+        """Authenticate and decrypt a message; data may be any bytes-like object, e.g. a memoryview"""
+        (counter,) = COUNTER.unpack_from(data)
+        if counter <= self.recv_counter:
+            raise ValueError("Replayed or reordered message")
+        header = bytes(data[:COUNTER.size])
+        payload = self.aead.decrypt(self.recv_prefix + header, data[COUNTER.size:], None)
+        self.recv_counter = counter
+        return payload
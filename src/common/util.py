@@ -1,5 +1,6 @@
 #Server
 import socket
+import select
 import threading
 import pyautogui
 import cv2
@@ -11,13 +12,13 @@ from io import BytesIO
 from cryptography.fernet import Fernet
 from time import sleep
 import platform
+import math
 
 #Client
 from tkinter import ttk, filedialog, messagebox, simpledialog, scrolledtext
 import argparse
 from datetime import datetime
 import time
-import torch
 import numpy as np
 
 
@@ -0,0 +1,159 @@
+import threading
+
+import cv2
+import numpy as np
+
+
+class CaptureBackend:
+    """Base class for screen capture backends
+
+    grab() returns the desktop as an RGB array. Each call must return a new array that the
+    backend never writes to again, because viewers keep references to frames they were sent.
+    """
+    name = None
+
+    def grab(self):
+        raise NotImplementedError("Subclasses must implement the grab method")
+
+    def size(self):
+        """Logical screen size (width, height) that input coordinates refer to"""
+        raise NotImplementedError("Subclasses must implement the size method")
+
+    def close(self):
+        """Release any native resources"""
+        pass
+
+
+class PyAutoGUIBackend(CaptureBackend):
+    """Capture through pyautogui/PIL; works everywhere pyautogui does, but copies each frame twice"""
+    name = 'pyautogui'
+
+    def __init__(self):
+        import pyautogui
+        self.pyautogui = pyautogui
+
+    def grab(self):
+        return np.array(self.pyautogui.screenshot())
+
+    def size(self):
+        return tuple(self.pyautogui.size())
+
+
+class MSSBackend(CaptureBackend):
+    """Capture with mss, which grabs through the platform's native API into a reused buffer
+
+    The BGRA grab is wrapped without copying and converted to RGB in a single pass.
+    """
+    name = 'mss'
+
+    def __init__(self, monitor=1):
+        import mss
+        self.mss = mss
+        self.monitor = monitor
+        # mss instances must not be shared between threads
+        self._local = threading.local()
+
+    def _instance(self):
+        sct = getattr(self._local, 'sct', None)
+        if sct is None:
+            sct = self._local.sct = self.mss.mss()
+        return sct
+
+    def grab(self):
+        sct = self._instance()
+        shot = sct.grab(sct.monitors[self.monitor])
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        return cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGB)
+
+    def size(self):
+        monitor = self._instance().monitors[self.monitor]
+        return monitor['width'], monitor['height']
+
+    def close(self):
+        sct = getattr(self._local, 'sct', None)
+        if sct is not None:
+            sct.close()
+            self._local.sct = None
+
+
+class SyntheticBackend(CaptureBackend):
+    """Generate scripted frames, so the server can run headless in tests and benchmarks
+
+    frames is either a list of RGB arrays that are played in a loop, or a callable taking the
+    frame index and returning an RGB array. By default a mostly static desktop is drawn with a
+    ticking clock and a scrolling text window.
+    """
+    name = 'synthetic'
+
+    def __init__(self, width=1920, height=1080, frames=None):
+        self.width = width
+        self.height = height
+        self.frames = frames
+        self.index = 0
+        self._desktop = None
+
+    def grab(self):
+        index = self.index
+        self.index += 1
+
+        if callable(self.frames):
+            return self.frames(index)
+        if self.frames:
+            return self.frames[index % len(self.frames)]
+        return self._scripted_frame(index)
+
+    def size(self):
+        return self.width, self.height
+
+    def _scripted_frame(self, index):
+        """Static desktop with a clock that changes every 10 frames and a window scrolling 4 px per frame"""
+        # The text window is up to 600 px wide and always fits inside the frame
+        top, left, rows = self.height // 6, self.width // 8, self.height // 2
+        cols = min(600, self.width - 2 * left)
+        if self._desktop is None:
+            self._desktop = np.full((self.height, self.width, 3), (58, 110, 165), dtype=np.uint8)
+            rng = np.random.default_rng(0)
+            self._text = 255 - rng.integers(0, 2, size=(self.height * 2, cols), dtype=np.uint8)[..., None] * 200
+
+        frame = self._desktop.copy()
+
+        # Scrolling text window
+        offset = (index * 4) % (self._text.shape[0] - rows)
+        frame[top:top + rows, left:left + cols] = self._text[offset:offset + rows]
+
+        # Taskbar clock
+        frame[-40:] = 32
+        cv2.putText(frame, f"{index // 10:06d}", (self.width - 140, self.height - 12),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 1)
+        return frame
+
+
+CAPTURE_BACKENDS = {
+    'pyautogui': PyAutoGUIBackend,
+    'mss': MSSBackend,
+    'synthetic': SyntheticBackend,
+}
+
+
+def create_capture_backend(name='auto', **kwargs):
+    """Create a capture backend by name; 'auto' prefers mss and falls back to pyautogui"""
+    if name == 'auto':
+        try:
+            return MSSBackend(**kwargs)
+        except ImportError:
+            return PyAutoGUIBackend()
+
+    if name not in CAPTURE_BACKENDS:
+        raise ValueError(f"Unknown capture backend: {name}")
+    return CAPTURE_BACKENDS[name](**kwargs)
+
+
+if __name__ == "__main__":
+    # Self-check of the scripted frames (from src/): python -m server.Capture_Backend
+    for width, height in ((1920, 1080), (640, 480), (320, 200)):
+        backend = SyntheticBackend(width, height)
+        frames = [backend.grab() for _ in range(12)]
+        assert all(frame.shape == (height, width, 3) for frame in frames), (width, height)
+        assert not np.array_equal(frames[0], frames[1]), "text window should scroll"
+        assert not np.array_equal(frames[0][-40:], frames[11][-40:]), "clock should tick"
+        print(f"synthetic {width}x{height}: ok")
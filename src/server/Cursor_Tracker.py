@@ -0,0 +1,114 @@
+import platform
+import threading
+import time
+
+# Standard Windows cursor ids (IDC_*) and the shape names sent to clients
+WINDOWS_CURSOR_SHAPES = {
+    32512: 'arrow',
+    32513: 'ibeam',
+    32514: 'wait',
+    32515: 'crosshair',
+    32642: 'size_nwse',
+    32643: 'size_nesw',
+    32644: 'size_we',
+    32645: 'size_ns',
+    32646: 'size_all',
+    32648: 'no',
+    32649: 'hand',
+    32650: 'progress',
+}
+
+
+class WindowsCursorShape:
+    """Name the current system cursor by comparing its handle with the standard cursors"""
+    def __init__(self):
+        import ctypes
+        from ctypes import wintypes
+
+        class CURSORINFO(ctypes.Structure):
+            _fields_ = [('cbSize', wintypes.DWORD), ('flags', wintypes.DWORD),
+                        ('hCursor', wintypes.HANDLE), ('ptScreenPos', wintypes.POINT)]
+
+        self.user32 = ctypes.windll.user32
+        self.user32.LoadCursorW.restype = wintypes.HANDLE
+        self.info = CURSORINFO()
+        self.info.cbSize = ctypes.sizeof(CURSORINFO)
+        self.shapes = {self.user32.LoadCursorW(None, cursor_id): name
+                       for cursor_id, name in WINDOWS_CURSOR_SHAPES.items()}
+        self.ctypes = ctypes
+
+    def __call__(self):
+        if not self.user32.GetCursorInfo(self.ctypes.byref(self.info)):
+            return None
+        if not self.info.flags:
+            return 'hidden'
+        # Application-defined cursors are shown as the plain arrow
+        return self.shapes.get(self.info.hCursor, 'arrow')
+
+
+class CursorTracker:
+    """Poll the pointer position and shape, and report each change
+
+    The capture backends leave the pointer out of the screenshot (or not, depending on the
+    platform), so clients draw it themselves from these reports and pointer movement alone never
+    causes a frame to be encoded. The server only runs the polling thread while a client is
+    streaming; poll() can also be called directly for a one-off reading.
+    """
+    def __init__(self, on_change, interval=0.02):
+        self.on_change = on_change  # called with {'x', 'y', 'shape'} from the tracker thread
+        self.interval = interval
+        self.lock = threading.Lock()  # start() and stop() come from the event loop and the UI
+        self.stopped = None  # Event that ends the current polling thread
+        self.thread = None
+        self.state = None
+
+        import pyautogui
+        self.pyautogui = pyautogui
+
+        # Only Windows tells us the cursor shape; elsewhere clients keep their default pointer
+        self.shape = None
+        if platform.system() == 'Windows':
+            try:
+                self.shape = WindowsCursorShape()
+            except Exception:
+                self.shape = None
+
+    def start(self):
+        """Start polling, unless already polling"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self._run, args=(self.stopped,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stop polling; the next start() reports the pointer afresh"""
+        with self.lock:
+            if self.thread is None:
+                return
+            self.stopped.set()
+            self.thread = None
+            self.state = None
+
+    def poll(self):
+        """Current pointer state in logical screen coordinates"""
+        x, y = self.pyautogui.position()
+        return {'x': int(x), 'y': int(y), 'shape': self.shape() if self.shape else None}
+
+    def _run(self, stopped):
+        # Each thread has its own stop event, so one stopped just before a restart can't linger
+        while not stopped.is_set():
+            try:
+                state = self.poll()
+                with self.lock:
+                    changed = not stopped.is_set() and state != self.state
+                    if changed:
+                        self.state = state
+                if changed:
+                    self.on_change(state)
+            except Exception:
+                # A failed poll (e.g. a locked desktop) is retried on the next tick
+                pass
+            stopped.wait(self.interval)
@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import deque
+
+# Events that only say where the pointer should be; a later one of the same kind makes them stale
+MOTION_TYPES = ('move', 'drag')
+
+# Injection latencies kept for the reported statistics
+LATENCY_SAMPLES = 256
+
+
+def merge_stale_moves(queued):
+    """Drop moves and drags that a directly following move or drag of the same kind supersedes
+
+    Clicks, scrolls and key presses are never dropped or reordered; a move right before a click
+    is kept, since the click may depend on the pointer having gone through it.
+    """
+    merged = []
+    for index, (cmd, queued_at) in enumerate(queued):
+        following = queued[index + 1][0] if index + 1 < len(queued) else None
+        if (following is not None and cmd.get('action') == 'mouse' and following.get('action') == 'mouse'
+                and cmd['type'] in MOTION_TYPES and following['type'] == cmd['type']
+                and following.get('button') == cmd.get('button')):
+            continue
+        merged.append((cmd, queued_at))
+    return merged
+
+
+class InputExecutor:
+    """Replay mouse and keyboard commands from all clients on one thread of their own
+
+    submit() only queues, so the network side never waits for pyautogui. pyautogui's PAUSE,
+    which sleeps 100 ms after every call by default, is set to a near-zero value, and moves that
+    are still queued behind a newer move are dropped rather than replayed. The time from
+    submit() to the end of each injection is kept for stats().
+    """
+    def __init__(self, log=print, pause=0.001):
+        self.log = log
+        self.pause = pause  # seconds pyautogui sleeps after each call
+        self.queue = deque()  # (command, time queued)
+        self.ready = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.injected = 0
+        self.merged = 0
+
+        import pyautogui
+        self.pyautogui = pyautogui
+
+    def start(self):
+        self.pyautogui.PAUSE = self.pause
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.ready:
+            self.running = False
+            self.queue.clear()
+            self.ready.notify()
+
+    def submit(self, commands):
+        """Queue commands for injection, in order; safe to call from any thread"""
+        now = time.perf_counter()
+        with self.ready:
+            self.queue.extend((cmd, now) for cmd in commands)
+            self.ready.notify()
+
+    def stats(self):
+        """Injection latency over the recent events, in milliseconds"""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {'input_events': self.injected, 'input_merged': self.merged, 'input_ms': None, 'input_p95_ms': None}
+        return {
+            'input_events': self.injected,
+            'input_merged': self.merged,
+            'input_ms': round(sum(latencies) / len(latencies) * 1000, 1),
+            'input_p95_ms': round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1)
+        }
+
+    def _run(self):
+        while True:
+            with self.ready:
+                self.ready.wait_for(lambda: self.queue or not self.running)
+                if not self.running:
+                    return
+                queued = list(self.queue)
+                self.queue.clear()
+
+            merged = merge_stale_moves(queued)
+            self.merged += len(queued) - len(merged)
+            for cmd, queued_at in merged:
+                self.inject(cmd)
+                self.latencies.append(time.perf_counter() - queued_at)
+                self.injected += 1
+
+    def inject(self, cmd):
+        """Replay one mouse or keyboard command"""
+        if cmd.get('action') == 'mouse':
+            self.handle_mouse(cmd)
+        elif cmd.get('action') == 'keyboard':
+            self.handle_keyboard(cmd)
+
+    def handle_mouse(self, cmd):
+        """Process mouse commands"""
+        pyautogui = self.pyautogui
+        try:
+            if cmd['type'] == 'move':
+                pyautogui.moveTo(cmd['x'], cmd['y'])
+            elif cmd['type'] == 'click':
+                pyautogui.click(cmd['x'], cmd['y'], button=cmd['button'])
+            elif cmd['type'] == 'double_click':
+                pyautogui.doubleClick(cmd['x'], cmd['y'], button=cmd['button'])
+            elif cmd['type'] == 'drag':
+                pyautogui.dragTo(cmd['x'], cmd['y'], button=cmd['button'])
+            elif cmd['type'] == 'scroll':
+                pyautogui.scroll(cmd['amount'])
+        except Exception as e:
+            self.log(f"Error executing mouse command: {str(e)}")
+
+    def handle_keyboard(self, cmd):
+        """Process keyboard commands"""
+        pyautogui = self.pyautogui
+        try:
+            if cmd['type'] == 'key':
+                pyautogui.press(cmd['key'])
+            elif cmd['type'] == 'hotkey':
+                pyautogui.hotkey(*cmd['keys'])
+            elif cmd['type'] == 'write':
+                pyautogui.write(cmd['text'])
+        except Exception as e:
+            self.log(f"Error executing keyboard command: {str(e)}")
@@ -0,0 +1,111 @@
+import cv2
+import numpy as np
+
+# Fewer changed tiles than this are cheaper to send than to search for motion
+MIN_MOTION_TILES = 6
+
+# Changed tiles checked against each candidate shift before the best one is applied to all
+MOTION_SAMPLE_TILES = 24
+
+# The shift is estimated on a downscaled image, then refined within this many pixels
+ESTIMATE_REDUCTION = 4
+REFINE_RADIUS = 3
+
+
+def estimate_shift(previous, current, bbox):
+    """Estimate the dominant (dx, dy) motion inside bbox, such that current[y, x] ~ previous[y - dy, x - dx]"""
+    x, y, w, h = bbox
+    reduction = ESTIMATE_REDUCTION if min(w, h) >= 32 * ESTIMATE_REDUCTION else 1
+
+    images = []
+    for frame in (previous, current):
+        gray = cv2.cvtColor(frame[y:y + h, x:x + w], cv2.COLOR_RGB2GRAY)
+        if reduction > 1:
+            gray = cv2.resize(gray, (w // reduction, h // reduction), interpolation=cv2.INTER_AREA)
+        images.append(np.float32(gray))
+
+    window = cv2.createHanningWindow(images[0].shape[::-1], cv2.CV_32F)
+    (dx, dy), _ = cv2.phaseCorrelate(images[0], images[1], window)
+    return round(dx * reduction), round(dy * reduction)
+
+
+def tile_moved(previous, current, tile, shift, tile_size):
+    """Check exactly whether a tile of current is the previous frame's pixels moved by shift"""
+    row, col = tile
+    dx, dy = shift
+    height, width = current.shape[:2]
+    y, x = row * tile_size, col * tile_size
+    h, w = min(tile_size, height - y), min(tile_size, width - x)
+
+    sy, sx = y - dy, x - dx
+    if sx < 0 or sy < 0 or sx + w > width or sy + h > height:
+        return False
+    return np.array_equal(previous[sy:sy + h, sx:sx + w], current[y:y + h, x:x + w])
+
+
+class MotionDetector:
+    """Find changed tiles that are just a scrolled or moved part of the previous frame
+
+    Such tiles can be sent as copy instructions instead of being encoded again. The estimate
+    comes from phase correlation over the changed area, but every tile is verified exactly, so a
+    wrong estimate only costs time, never correctness.
+    """
+    def __init__(self, tile_size):
+        self.tile_size = tile_size
+        self.last_shift = None  # Scrolls usually continue, so this is tried first
+
+    def detect(self, previous, current, changed):
+        """Find the changed tiles that moved; returns a mask of them and their (dx, dy) shift
+
+        The mask is None when no motion was found. A moved tile at (x, y) holds the previous
+        frame's pixels from (x - dx, y - dy).
+        """
+        tiles = np.argwhere(changed)
+        if len(tiles) < MIN_MOTION_TILES:
+            return None, None
+
+        shift = self._find_shift(previous, current, tiles)
+        self.last_shift = shift
+        if shift is None:
+            return None, None
+
+        moved = np.zeros_like(changed)
+        for tile in tiles:
+            moved[tuple(tile)] = tile_moved(previous, current, tuple(tile), shift, self.tile_size)
+        return moved, shift
+
+    def _find_shift(self, previous, current, tiles):
+        """Pick the shift that explains most of a sample of the changed tiles, if any does"""
+        step = max(1, len(tiles) // MOTION_SAMPLE_TILES)
+        sample = [tuple(tile) for tile in tiles[::step]]
+        needed = max(2, len(sample) // 4)
+
+        def explained(shift):
+            return sum(tile_moved(previous, current, tile, shift, self.tile_size) for tile in sample)
+
+        # A scroll in progress keeps its shift; checking it first skips the estimate
+        if self.last_shift is not None and explained(self.last_shift) >= needed:
+            return self.last_shift
+
+        rows, cols = tiles[:, 0], tiles[:, 1]
+        height, width = current.shape[:2]
+        x, y = cols.min() * self.tile_size, rows.min() * self.tile_size
+        bbox = (x, y, min((cols.max() + 1) * self.tile_size, width) - x,
+                min((rows.max() + 1) * self.tile_size, height) - y)
+        dx, dy = estimate_shift(previous, current, bbox)
+
+        # The downscaled estimate is only close; try the nearest exact shifts first
+        best, best_count = None, 0
+        offsets = sorted(((ox, oy) for ox in range(-REFINE_RADIUS, REFINE_RADIUS + 1)
+                          for oy in range(-REFINE_RADIUS, REFINE_RADIUS + 1)),
+                         key=lambda offset: abs(offset[0]) + abs(offset[1]))
+        for ox, oy in offsets:
+            shift = (dx + ox, dy + oy)
+            if shift == (0, 0):
+                continue
+            count = explained(shift)
+            if count > best_count:
+                best, best_count = shift, count
+                if count == len(sample):
+                    break
+        return best if best_count >= needed else None
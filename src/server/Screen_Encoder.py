@@ -0,0 +1,191 @@
+import zlib
+
+import cv2
+import numpy as np
+from common.Frame_Format import CODEC_JPEG, CODEC_PNG, CODEC_WEBP
+from server.Motion_Detector import MotionDetector
+
+# Edge length of the square tiles the screen is split into for change detection
+TILE_SIZE = 64
+
+# Tiles where at least this share of pixels repeat their left neighbour exactly hold text or
+# flat UI and are sent losslessly; photos and noisy gradients almost never repeat a pixel and
+# are sent as JPEG
+LOSSLESS_MIN_FLATNESS = 0.4
+
+# Lossless WebP roughly thirds the bytes of a text screen against JPEG, but takes about 20 times
+# as long to encode (170 ms against 8 ms for a full 1080p text frame, see bench_codecs). PNG text
+# tiles come out about twice the size of JPEG, so without WebP flat tiles stay on JPEG too.
+LOSSLESS_CODEC = CODEC_WEBP if cv2.haveImageWriter('.webp') else None
+
+# Codec names this server can produce, for capability negotiation, most preferred first
+ENCODABLE_CODECS = (['webp'] if LOSSLESS_CODEC == CODEC_WEBP else []) + ['png', 'jpeg', 'copy']
+
+
+def merge_tile_rects(mask, tile_size, width, height):
+    """Merge runs of changed tiles on each tile row into (x, y, w, h) rectangles"""
+    rects = []
+    for row, row_mask in enumerate(mask):
+        col = 0
+        cols = len(row_mask)
+        while col < cols:
+            if not row_mask[col]:
+                col += 1
+                continue
+
+            start = col
+            while col < cols and row_mask[col]:
+                col += 1
+
+            x = start * tile_size
+            y = row * tile_size
+            rects.append((x, y, min(col * tile_size, width) - x, min(tile_size, height - y)))
+    return rects
+
+
+def full_frame_rects(width, height, tile_size=TILE_SIZE):
+    """Split a whole frame into tile-high strips, so it can be encoded in parallel"""
+    rows = -(-height // tile_size)
+    cols = -(-width // tile_size)
+    return merge_tile_rects(np.ones((rows, cols), dtype=bool), tile_size, width, height)
+
+
+def tile_hashes(frame, tile_size=TILE_SIZE):
+    """Return a (rows, cols) grid of CRC-32 checksums, one per tile of frame"""
+    height, width = frame.shape[:2]
+    rows = -(-height // tile_size)
+    cols = -(-width // tile_size)
+
+    hashes = np.empty((rows, cols), dtype=np.uint32)
+    for row in range(rows):
+        strip = frame[row * tile_size:(row + 1) * tile_size]
+        for col in range(cols):
+            hashes[row, col] = zlib.crc32(np.ascontiguousarray(strip[:, col * tile_size:(col + 1) * tile_size]))
+    return hashes
+
+
+class TileDiffer:
+    """Track the tiles last sent to one client and work out which parts of a new frame changed
+
+    Tiles are compared by checksum, so the grid computed once per captured frame can be shared
+    by every viewer instead of each one comparing pixels against its own previous frame.
+    """
+    def __init__(self, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.last_frame = None
+        self.last_hashes = None
+        self.motion = MotionDetector(tile_size)
+
+    def reset(self):
+        """Forget the last frame so the next diff covers the whole screen"""
+        self.last_frame = None
+        self.last_hashes = None
+
+    def diff(self, frame, hashes=None, copies=False):
+        """Return the changes in frame as (copies, rects) and remember it as the client's current frame
+
+        hashes is the frame's tile_hashes() grid, if the caller already has it. With copies set,
+        scrolled or moved regions come back as ((x, y, w, h), (src_x, src_y)) copies of the
+        previous frame instead of rectangles to encode.
+        """
+        height, width = frame.shape[:2]
+        if hashes is None:
+            hashes = tile_hashes(frame, self.tile_size)
+
+        moves = []
+        if self.last_frame is None or self.last_frame.shape != frame.shape:
+            # First frame or resolution change: everything is new
+            rects = full_frame_rects(width, height, self.tile_size)
+        else:
+            changed = hashes != self.last_hashes
+            moved, shift = self.motion.detect(self.last_frame, frame, changed) if copies else (None, None)
+            if moved is not None:
+                dx, dy = shift
+                moves = [(rect, (rect[0] - dx, rect[1] - dy))
+                         for rect in merge_tile_rects(moved, self.tile_size, width, height)]
+                changed &= ~moved
+            rects = merge_tile_rects(changed, self.tile_size, width, height)
+
+        # Captured frames are never modified after capture, so keeping a reference is enough
+        self.last_frame = frame
+        self.last_hashes = hashes
+        return moves, rects
+
+
+def tile_flatness(frame, rect, tile_size=TILE_SIZE):
+    """Share of pixels exactly equal to their left neighbour, for each tile of a row run
+
+    Sampled on every other pixel row, which is plenty to tell text and UI from photos.
+    """
+    x, y, w, h = rect
+    region = frame[y:y + h:2, x:x + w]
+
+    # Pack each pixel into one integer, so neighbours compare in a single operation
+    packed = region[..., 0].astype(np.uint32) << 16
+    packed |= region[..., 1].astype(np.uint32) << 8
+    packed |= region[..., 2]
+
+    repeats = np.ones(packed.shape, dtype=bool)
+    repeats[:, 1:] = packed[:, 1:] == packed[:, :-1]
+
+    starts = np.arange(0, w, tile_size)
+    widths = np.minimum(starts + tile_size, w) - starts
+    return np.add.reduceat(repeats.sum(axis=0), starts) / (widths * packed.shape[0])
+
+
+def classify_rects(frame, rects, tile_size=TILE_SIZE, lossless_codec=LOSSLESS_CODEC):
+    """Split rectangles into runs of tiles that share a codec; returns (rect, codec) pairs
+
+    Without a lossless codec every rectangle stays on JPEG.
+    """
+    if lossless_codec is None:
+        return [(rect, CODEC_JPEG) for rect in rects]
+    coded = []
+    for rect in rects:
+        x, y, w, h = rect
+        flat = tile_flatness(frame, rect, tile_size) >= LOSSLESS_MIN_FLATNESS
+        codecs = np.where(flat, lossless_codec, CODEC_JPEG).tolist()
+
+        start = 0
+        for col in range(1, len(codecs) + 1):
+            if col == len(codecs) or codecs[col] != codecs[start]:
+                run_x = x + start * tile_size
+                run_w = min(col * tile_size, w) - start * tile_size
+                coded.append(((run_x, y, run_w, h), codecs[start]))
+                start = col
+    return coded
+
+
+def encode_rect(frame, rect, quality, codec=CODEC_JPEG):
+    """Encode one (x, y, w, h) rectangle of frame with the given codec"""
+    x, y, w, h = rect
+    region = frame[y:y + h, x:x + w]
+    if codec == CODEC_JPEG:
+        _, buffer = cv2.imencode('.jpg', region, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    elif codec == CODEC_WEBP:
+        # Quality above 100 selects lossless WebP
+        _, buffer = cv2.imencode('.webp', region, [cv2.IMWRITE_WEBP_QUALITY, 101])
+    elif codec == CODEC_PNG:
+        _, buffer = cv2.imencode('.png', region, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    else:
+        raise ValueError(f"Unknown tile codec: {codec}")
+    return buffer
+
+
+def make_tile(rect, data, codec=CODEC_JPEG):
+    """Build the tile dict for an encoded rectangle"""
+    x, y, w, h = rect
+    return {
+        'x': x,
+        'y': y,
+        'w': w,
+        'h': h,
+        'codec': codec,
+        'data': data
+    }
+
+
+def encode_tiles(frame, rects, quality, lossless=True, lossless_codec=LOSSLESS_CODEC):
+    """Encode the given rectangles of frame into tile dicts, flat regions losslessly"""
+    coded = classify_rects(frame, rects, lossless_codec=lossless_codec) if lossless else [(rect, CODEC_JPEG) for rect in rects]
+    return [make_tile(rect, encode_rect(frame, rect, quality, codec), codec) for rect, codec in coded]
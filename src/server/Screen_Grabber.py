@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from common.Frame_Format import CODEC_JPEG
+from server.Screen_Encoder import LOSSLESS_CODEC, classify_rects, encode_rect, make_tile, tile_hashes
+
+# Encoder threads used by default; OpenCV releases the GIL while encoding
+DEFAULT_ENCODE_THREADS = min(4, os.cpu_count() or 1)
+
+
+class ScreenGrabber:
+    """Capture the desktop once per tick and share the frame and its encodings between all viewers"""
+    def __init__(self, backend, encode_threads=DEFAULT_ENCODE_THREADS):
+        self.backend = backend
+        self.lock = threading.Lock()
+        
+        # Rectangles of one frame are encoded concurrently when more than one thread is configured
+        self.encode_threads = encode_threads
+        self.executor = ThreadPoolExecutor(encode_threads, thread_name_prefix='encode') if encode_threads > 1 else None
+        self.frame = None
+        self.frame_id = 0
+        self.captured_at = 0.0
+        
+        # Capture cost, in seconds: the last grab and a smoothed average
+        self.capture_time = 0.0
+        self.avg_capture_time = None
+
+        # Downscaled copies of the current frame, keyed by scale
+        self._scaled = {}
+
+        # Tile checksum grids of the current frame, keyed by scale
+        self._hashes = {}
+
+        # Encoded rectangles of the current frame, keyed by (rect, codec, quality, scale).
+        # A value is an Event while some viewer is still encoding it.
+        self._encoded = {}
+
+    def grab(self, max_age=0.0, scale=1.0):
+        """Return (frame_id, frame), capturing a new frame only if the current one is older than max_age"""
+        with self.lock:
+            now = time.time()
+            if self.frame is None or now - self.captured_at > max_age:
+                # Each capture is a new array, so viewers may keep references to earlier frames
+                start = time.perf_counter()
+                self.frame = self.backend.grab()
+                self.capture_time = time.perf_counter() - start
+                if self.avg_capture_time is None:
+                    self.avg_capture_time = self.capture_time
+                else:
+                    self.avg_capture_time = 0.9 * self.avg_capture_time + 0.1 * self.capture_time
+                self.frame_id += 1
+                self.captured_at = now
+                self._scaled = {}
+                self._hashes = {}
+                self._encoded = {}
+
+            if scale == 1.0:
+                return self.frame_id, self.frame
+
+            scaled = self._scaled.get(scale)
+            if scaled is None:
+                height, width = self.frame.shape[:2]
+                size = (max(1, round(width * scale)), max(1, round(height * scale)))
+                scaled = self._scaled[scale] = cv2.resize(self.frame, size, interpolation=cv2.INTER_AREA)
+            return self.frame_id, scaled
+
+    def tile_hashes(self, frame_id, frame, scale=1.0):
+        """Tile checksums of a grabbed frame, computed once and shared by all viewers"""
+        with self.lock:
+            if frame_id == self.frame_id and scale in self._hashes:
+                return self._hashes[scale]
+
+        # Hash outside the lock; two viewers racing on a new frame at worst both compute it
+        hashes = tile_hashes(frame)
+        with self.lock:
+            if frame_id == self.frame_id:
+                self._hashes[scale] = hashes
+        return hashes
+
+    def encode_tiles(self, frame_id, frame, rects, quality, scale=1.0, lossless=True, lossless_codec=LOSSLESS_CODEC):
+        """Encode rectangles of a grabbed frame into tiles, reusing encodings other viewers already made
+
+        With lossless set, flat text and UI regions get lossless_codec and the rest JPEG.
+        """
+        coded = classify_rects(frame, rects, lossless_codec=lossless_codec) if lossless else [(rect, CODEC_JPEG) for rect in rects]
+        if self.executor is not None and len(coded) > 1:
+            buffers = self.executor.map(lambda item: self._encode(frame_id, frame, *item, quality, scale), coded)
+        else:
+            buffers = (self._encode(frame_id, frame, rect, codec, quality, scale) for rect, codec in coded)
+        return [make_tile(rect, buffer, codec) for (rect, codec), buffer in zip(coded, buffers)]
+
+    def shutdown(self):
+        """Stop the encoder threads and release the capture backend"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.backend.close()
+
+    def _encode(self, frame_id, frame, rect, codec, quality, scale):
+        """Encode one rectangle, or wait for the viewer that is already encoding it"""
+        # Lossless encodings don't depend on the quality, so all viewers can share them
+        key = (rect, codec, quality if codec == CODEC_JPEG else None, scale)
+        owner = False
+        with self.lock:
+            if frame_id == self.frame_id:
+                cached = self._encoded.get(key)
+                if cached is None:
+                    cached = self._encoded[key] = threading.Event()
+                    owner = True
+            else:
+                # The frame has already been replaced; encode it without caching
+                cached = None
+
+        if not owner and cached is not None:
+            if not isinstance(cached, threading.Event):
+                return cached
+
+            cached.wait()
+            with self.lock:
+                result = self._encoded.get(key)
+            if result is not None and not isinstance(result, threading.Event):
+                return result
+
+        try:
+            buffer = encode_rect(frame, rect, quality, codec)
+            if owner:
+                with self.lock:
+                    if self._encoded.get(key) is cached:
+                        self._encoded[key] = buffer
+            return buffer
+        finally:
+            if owner:
+                cached.set()
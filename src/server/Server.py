@@ -9,21 +9,22 @@ import Globals as gb
 
 # Import the UI parser
 from common.ui_parser import TkUIParser
+from server.Screen_Grabber import ScreenGrabber, DEFAULT_ENCODE_THREADS
+from server.Capture_Backend import create_capture_backend
+from server.Server_Core import ServerCore
 
 class RemoteControlServer:
-    def __init__(self, tk):
+    def __init__(self, tk, capture_backend='auto'):
         lg.logger.info("initiating Server")
-        """Initialize the Remote Control Server application"""
+        """Initialize the Remote Control Server application
+        
+        capture_backend is a backend name from CAPTURE_BACKENDS, 'auto', or a CaptureBackend instance.
+        """
         self.host = '0.0.0.0'  # Listen on all available interfaces
         self.port = 5000
         self.password = 'secure_password'
-        self.socket = None
         self.running = False
-        self.clients = []
-        
-        # Generate key from password (will be updated when server starts)
-        key = base64.urlsafe_b64encode(self.password.ljust(32)[:32].encode())
-        self.cipher = Fernet(key)
+        self.listed_clients = []  # Clients in the order the listbox shows them
         
         # Screen dimensions (will be updated when server starts)
         self.screen_width, self.screen_height = 0, 0
@@ -32,6 +33,15 @@ class RemoteControlServer:
         self.image_quality = 30  # JPEG compression (0-100)
         self.update_rate = 0.5  # seconds between screen updates
         
+        # Shared capture/encode stage for all viewers and the preview
+        self.encode_threads = DEFAULT_ENCODE_THREADS
+        if isinstance(capture_backend, str):
+            capture_backend = create_capture_backend(capture_backend)
+        self.grabber = ScreenGrabber(capture_backend, encode_threads=self.encode_threads)
+        
+        # The sessions themselves run on the core's event loop; this class is only its UI
+        self.core = ServerCore(self.grabber, log=self.log, on_clients_changed=self.update_client_list)
+        
         # Create the root Tkinter window
         self.tk = tk
         self.root = tk.Tk()
@@ -122,32 +132,17 @@ class RemoteControlServer:
         try:
             # Update config from UI
             self.port = self.port_var.get()
-            new_password = self.password_var.get()
-            
-            # Update encryption key if password changed
-            if new_password != self.password:
-                self.password = new_password
-                key = base64.urlsafe_b64encode(self.password.ljust(32)[:32].encode())
-                self.cipher = Fernet(key)
+            self.password = self.password_var.get()
             
             # Update quality settings
             self.image_quality = self.quality_var.get()
             self.update_rate = self.rate_var.get()
-            
-            # Create socket
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.core.image_quality = self.image_quality
             
             # Bind and start listening
             selected_ip = self.ip_var.get()
-            self.socket.bind((self.host, self.port))  # Bind to all interfaces
-            self.socket.listen(5)
-            
-            # Start the server thread
+            self.core.start(self.host, self.port, self.password)  # Bind to all interfaces
             self.running = True
-            self.server_thread = threading.Thread(target=self.run_server)
-            self.server_thread.daemon = True
-            self.server_thread.start()
             
             # Start screen preview thread
             self.preview_thread = threading.Thread(target=self.update_preview)
@@ -167,35 +162,19 @@ class RemoteControlServer:
             self.log(f"  - Password: {self.password}")
             
             # Get screen dimensions
-            self.screen_width, self.screen_height = pyautogui.size()
+            self.screen_width, self.screen_height = self.core.screen_width, self.core.screen_height
+            self.log(f"Screen capture: {self.grabber.backend.name} backend, {self.screen_width}x{self.screen_height}")
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to start server: {str(e)}")
             self.running = False
-            if self.socket:
-                self.socket.close()
-                self.socket = None
     
     def stop_server(self):
         """Stop the server"""
         self.running = False
         
-        # Close all client connections
-        for client in self.clients:
-            try:
-                client['socket'].close()
-            except:
-                pass
-        
-        self.clients = []
-        
-        # Close server socket
-        if self.socket:
-            try:
-                self.socket.close()
-            except:
-                pass
-            self.socket = None
+        # Close the listener and all client connections
+        self.core.stop()
         
         # Update UI
         self.status_var.set("Stopped")
@@ -206,280 +185,6 @@ class RemoteControlServer:
         # Log
         self.log("Server stopped")
     
-    def run_server(self):
-        """Main server thread that accepts connections"""
-        while self.running:
-            try:
-                client_socket, addr = self.socket.accept()
-                
-                # Start a new thread to handle the client
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, addr)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-                
-            except Exception as e:
-                if self.running:  # Only log if we're still supposed to be running
-                    self.log(f"Error accepting connection: {str(e)}")
-            
-            sleep(0.1)  # Small delay to prevent CPU hogging
-    
-    def handle_client(self, client_socket, addr):
-        """Handle a client connection"""
-        client_info = {
-            'socket': client_socket,
-            'address': addr,
-            'authenticated': False,
-            'last_activity': datetime.now()
-        }
-        
-        try:
-            # Authentication
-            if not self.authenticate_client(client_socket, addr):
-                self.log(f"Failed authentication attempt from {addr[0]}:{addr[1]}")
-                client_socket.close()
-                return
-            
-            client_info['authenticated'] = True
-            self.clients.append(client_info)
-            
-            # Update client list in UI
-            self.update_client_list()
-            
-            self.log(f"Client connected: {addr[0]}:{addr[1]}")
-            
-            # Main communication loop
-            while self.running and client_socket:
-                try:
-                    # Receive encrypted command
-                    encrypted_data = client_socket.recv(4096)
-                    if not encrypted_data:
-                        break
-                    
-                    # Decrypt command
-                    data = self.cipher.decrypt(encrypted_data).decode()
-                    cmd = json.loads(data)
-                    
-                    # Update activity timestamp
-                    client_info['last_activity'] = datetime.now()
-                    
-                    # Process command
-                    if cmd['action'] == 'screen':
-                        self.send_screen(client_socket)
-                    elif cmd['action'] == 'mouse':
-                        self.handle_mouse(cmd)
-                        self.log(f"Mouse action: {cmd['type']} from {addr[0]}:{addr[1]}")
-                    elif cmd['action'] == 'keyboard':
-                        self.handle_keyboard(cmd)
-                        self.log(f"Keyboard action: {cmd['type']} from {addr[0]}:{addr[1]}")
-                    elif cmd['action'] == 'file_download':
-                        self.send_file(client_socket, cmd['path'])
-                        self.log(f"File download request: {cmd['path']} from {addr[0]}:{addr[1]}")
-                    elif cmd['action'] == 'file_upload':
-                        self.receive_file(client_socket, cmd['path'], cmd['size'])
-                        self.log(f"File upload: {cmd['path']} ({cmd['size']} bytes) from {addr[0]}:{addr[1]}")
-                
-                except Exception as e:
-                    self.log(f"Error handling client {addr[0]}:{addr[1]}: {str(e)}")
-                    break
-        
-        except Exception as e:
-            self.log(f"Client error {addr[0]}:{addr[1]}: {str(e)}")
-        
-        finally:
-            # Remove client from list
-            if client_info in self.clients:
-                self.clients.remove(client_info)
-            
-            # Close socket
-            try:
-                client_socket.close()
-            except:
-                pass
-            
-            # Update client list in UI
-            self.update_client_list()
-            
-            self.log(f"Client disconnected: {addr[0]}:{addr[1]}")
-    
-    def authenticate_client(self, client_socket, addr):
-        """Authenticate a client connection"""
-        try:
-            # Receive authentication request
-            auth_data = client_socket.recv(1024)
-            
-            # Decrypt the authentication data
-            try:
-                decrypted = self.cipher.decrypt(auth_data).decode()
-                auth = json.loads(decrypted)
-                
-                # Check the password
-                if auth.get('password') == self.password:
-                    # Send success response
-                    response = {'status': 'success'}
-                    encrypted = self.cipher.encrypt(json.dumps(response).encode())
-                    client_socket.send(encrypted)
-                    return True
-                else:
-                    # Send failure response
-                    response = {'status': 'failed', 'reason': 'Invalid password'}
-                    encrypted = self.cipher.encrypt(json.dumps(response).encode())
-                    client_socket.send(encrypted)
-                    return False
-            
-            except Exception as e:
-                # Decryption failed - send error response
-                response = {'status': 'failed', 'reason': 'Authentication error'}
-                try:
-                    # Try to create a new cipher with the received data as if it were a password
-                    # This helps when client uses a different password
-                    temp_key = base64.urlsafe_b64encode(auth_data[:32].ljust(32, b'='))
-                    temp_cipher = Fernet(temp_key)
-                    encrypted = temp_cipher.encrypt(json.dumps(response).encode())
-                    client_socket.send(encrypted)
-                except:
-                    # If that fails too, just send raw error
-                    client_socket.send(json.dumps(response).encode())
-                return False
-        
-        except Exception as e:
-            self.log(f"Authentication error with {addr[0]}:{addr[1]}: {str(e)}")
-            return False
-    
-    def send_screen(self, client_socket):
-        """Capture and send screen to client"""
-        try:
-            # Capture screen
-            screenshot = pyautogui.screenshot()
-            screenshot_np = np.array(screenshot)
-            
-            # Convert to JPEG with compression
-            _, buffer = cv2.imencode('.jpg', screenshot_np, [cv2.IMWRITE_JPEG_QUALITY, self.image_quality])
-            jpg_as_text = base64.b64encode(buffer).decode()
-            
-            # Send screen data
-            screen_data = {
-                'width': self.screen_width,
-                'height': self.screen_height,
-                'image': jpg_as_text
-            }
-            
-            encrypted = self.cipher.encrypt(json.dumps(screen_data).encode())
-            
-            # Send size first, then data
-            size = len(encrypted)
-            client_socket.send(size.to_bytes(4, byteorder='big'))
-            client_socket.send(encrypted)
-        
-        except Exception as e:
-            self.log(f"Error sending screen: {str(e)}")
-            raise
-    
-    def handle_mouse(self, cmd):
-        """Process mouse commands"""
-        try:
-            if cmd['type'] == 'move':
-                pyautogui.moveTo(cmd['x'], cmd['y'])
-            elif cmd['type'] == 'click':
-                pyautogui.click(cmd['x'], cmd['y'], button=cmd['button'])
-            elif cmd['type'] == 'double_click':
-                pyautogui.doubleClick(cmd['x'], cmd['y'], button=cmd['button'])
-            elif cmd['type'] == 'drag':
-                pyautogui.dragTo(cmd['x'], cmd['y'], button=cmd['button'])
-            elif cmd['type'] == 'scroll':
-                pyautogui.scroll(cmd['amount'])
-        except Exception as e:
-            self.log(f"Error executing mouse command: {str(e)}")
-    
-    def handle_keyboard(self, cmd):
-        """Process keyboard commands"""
-        try:
-            if cmd['type'] == 'key':
-                pyautogui.press(cmd['key'])
-            elif cmd['type'] == 'hotkey':
-                pyautogui.hotkey(*cmd['keys'])
-            elif cmd['type'] == 'write':
-                pyautogui.write(cmd['text'])
-        except Exception as e:
-            self.log(f"Error executing keyboard command: {str(e)}")
-    
-    def send_file(self, client_socket, path):
-        """Send file to client"""
-        try:
-            # Check if file exists
-            if not os.path.isfile(path):
-                error_data = {'error': 'File not found'}
-                encrypted = self.cipher.encrypt(json.dumps(error_data).encode())
-                client_socket.send(encrypted)
-                return
-            
-            # Read file data
-            with open(path, 'rb') as file:
-                file_data = file.read()
-            
-            # Send file size
-            size_data = {'size': len(file_data)}
-            encrypted = self.cipher.encrypt(json.dumps(size_data).encode())
-            client_socket.send(encrypted)
-            
-            # Send file data in chunks
-            chunk_size = 4096
-            for i in range(0, len(file_data), chunk_size):
-                chunk = file_data[i:i+chunk_size]
-                encrypted_chunk = self.cipher.encrypt(chunk)
-                client_socket.send(encrypted_chunk)
-            
-            self.log(f"File sent: {path} ({len(file_data)} bytes)")
-        
-        except Exception as e:
-            self.log(f"Error sending file {path}: {str(e)}")
-            # Try to send error message
-            try:
-                error_data = {'error': str(e)}
-                encrypted = self.cipher.encrypt(json.dumps(error_data).encode())
-                client_socket.send(encrypted)
-            except:
-                pass
-    
-    def receive_file(self, client_socket, path, size):
-        """Receive file from client"""
-        try:
-            # Create directory if it doesn't exist
-            directory = os.path.dirname(path)
-            if directory and not os.path.exists(directory):
-                os.makedirs(directory)
-            
-            # Receive file data
-            with open(path, 'wb') as file:
-                received = 0
-                while received < size:
-                    encrypted_chunk = client_socket.recv(4096)
-                    if not encrypted_chunk:
-                        break
-                    
-                    chunk = self.cipher.decrypt(encrypted_chunk)
-                    file.write(chunk)
-                    received += len(chunk)
-            
-            # Send confirmation
-            response = {'status': 'success'}
-            encrypted = self.cipher.encrypt(json.dumps(response).encode())
-            client_socket.send(encrypted)
-            
-            self.log(f"File received: {path} ({received} bytes)")
-        
-        except Exception as e:
-            self.log(f"Error receiving file {path}: {str(e)}")
-            # Try to send error message
-            try:
-                response = {'status': 'error', 'message': str(e)}
-                encrypted = self.cipher.encrypt(json.dumps(response).encode())
-                client_socket.send(encrypted)
-            except:
-                pass
-    
     def update_client_list(self):
         """Update the client list in the UI"""
         # This needs to be run on the main thread
@@ -488,10 +193,11 @@ class RemoteControlServer:
     def _update_client_list(self):
         """Internal method to update client listbox (runs on main thread)"""
         self.client_listbox.delete(0, self.tk.END)
-        for client in self.clients:
-            if client['authenticated']:
-                addr = client['address']
-                self.client_listbox.insert(self.tk.END, f"{addr[0]}:{addr[1]}")
+        # Remember what is listed, as the core's list changes under us
+        self.listed_clients = list(self.core.clients)
+        for client in self.listed_clients:
+            addr = client['address']
+            self.client_listbox.insert(self.tk.END, f"{addr[0]}:{addr[1]}")
     
     def disconnect_client(self):
         """Disconnect the selected client"""
@@ -500,24 +206,22 @@ class RemoteControlServer:
             return
         
         index = selection[0]
-        if index >= len(self.clients):
+        if index >= len(self.listed_clients):
             return
         
-        client = self.clients[index]
-        try:
-            client['socket'].close()
-        except:
-            pass
+        client = self.listed_clients[index]
+        self.core.disconnect(client)
         
-        # The client will be removed from the list in the handle_client method
+        # The client will be removed from the list when its session ends
         self.log(f"Disconnected client: {client['address'][0]}:{client['address'][1]}")
     
     def update_preview(self):
         """Update the screen preview periodically"""
         while self.running:
             try:
-                # Capture screen
-                screenshot = pyautogui.screenshot()
+                # Reuse a viewer's capture when there is a recent one
+                _, frame = self.grabber.grab(max_age=1.0)
+                screenshot = PIL.Image.fromarray(frame)
                 
                 # Resize for preview
                 canvas_width = self.preview_canvas.winfo_width()
@@ -599,6 +303,7 @@ class RemoteControlServer:
     def run(self):
         """Run the server application"""
         self.root.mainloop()
+        self.grabber.shutdown()
 
 
 
@@ -0,0 +1,926 @@
+import asyncio
+import base64
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from cryptography.fernet import Fernet
+
+from server.Screen_Encoder import ENCODABLE_CODECS, LOSSLESS_CODEC, TileDiffer, full_frame_rects, make_tile
+from server.Stream_Controller import StreamController
+from server.Cursor_Tracker import CursorTracker
+from server.Input_Executor import InputExecutor
+from common.Frame_Format import CODEC_COPY, CODEC_WEBP, COPY_SOURCE, pack_frame, tiles_to_json
+from common.Connection import (AUTH_MAX_SIZE, AsyncMessageStream, BULK_CHUNK_SIZE, CHANNEL_BULK, CHANNEL_HEARTBEAT,
+                               CHANNEL_SCREEN, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+from common.Session_Cipher import SessionCipher, derive_session_key, handshake_nonce
+from common.Capabilities import describe, legacy_hello, local_capabilities, negotiate_capabilities
+
+# Bytes read from disk per file executor call when sending a file; a download holds no more in memory
+FILE_BLOCK_SIZE = 256 * 1024
+
+
+class ServerCore:
+    """The remote control server itself, without any UI
+
+    All client sessions run as coroutines on one asyncio event loop in a background thread, so
+    a session costs a few objects rather than a thread, and accepting is limited only by the
+    loop. Work that blocks - capturing, diffing and packing frames, and driving the mouse and
+    keyboard - runs in executors, and the loop only moves bytes. The UI talks to it through
+    start(), stop() and disconnect(), and hears back through the log and on_clients_changed
+    callbacks, which are called from the loop thread.
+    """
+    def __init__(self, grabber, log=print, on_clients_changed=None):
+        self.grabber = grabber  # Shared capture/encode stage for all sessions
+        self.log = log
+        self.on_clients_changed = on_clients_changed or (lambda: None)
+        self.running = False
+        self.clients = []  # client_info dicts of the authenticated sessions
+
+        self.password = None
+        self.cipher = None
+
+        # Screen dimensions (updated when the server starts)
+        self.screen_width, self.screen_height = 0, 0
+
+        # Quality settings
+        self.image_quality = 30  # JPEG compression (0-100)
+        # Send text and flat UI tiles as lossless WebP instead of JPEG: about a third of the bytes on
+        # text screens, but ~20x the encode time of JPEG for those tiles; off where WebP is missing
+        self.lossless_tiles = LOSSLESS_CODEC is not None
+        self.request_max_age = 0.05  # seconds a captured frame may be reused for polled screen requests
+        self.latency_target = 0.15  # seconds, what the per-client stream controllers aim for
+        self.stats_interval = 1.0  # seconds between stream stats sent to streaming clients
+        self.idle_after = 1.0  # seconds without screen changes before a stream slows its capture rate
+        self.idle_interval = 0.25  # seconds between captures while a stream is idle
+        self.unchanged_interval = 1.0  # seconds between 'unchanged' notices on an idle stream
+        self.cursor_interval = 0.02  # seconds between pointer polls; changes go to streaming clients
+        self.auth_timeout = 10.0  # seconds a new connection has to authenticate
+        self.heartbeat_interval = HEARTBEAT_INTERVAL  # seconds between heartbeats to clients that take them
+        self.heartbeat_timeout = HEARTBEAT_TIMEOUT  # seconds of silence before such a client counts as gone
+        self.session_timeout = 300.0  # seconds of silence before a client without heartbeats is dropped
+        self.ticket_ttl = 60.0  # seconds a dropped session can be resumed with its ticket
+        self.tickets = {}  # ticket -> {'session': client_info, 'expires': monotonic time, None while connected}
+        self.frame_threads = None  # workers that capture, diff and pack frames; None sizes by CPU count
+        self.input_pause = 0.001  # seconds pyautogui sleeps after each injected call (its default is 0.1)
+        self.cursor_tracker = None
+
+        self.loop = None
+        self.server = None
+        self.maintenance = None  # Task sending heartbeats and reaping dead sessions
+        self.executor = None  # Frame work for all sessions
+        self.file_executor = None  # Disk reads and writes of file transfers, so a slow disk holds up neither the loop nor frames
+        self.input_executor = None  # Replays input from all sessions in order, on its own thread
+
+    def start(self, host, port, password):
+        """Start listening on a new event loop; raises if the address cannot be bound"""
+        self.password = password
+        key = base64.urlsafe_b64encode(self.password.ljust(32)[:32].encode())
+        self.cipher = Fernet(key)
+        self.screen_width, self.screen_height = self.grabber.backend.size()
+
+        self.executor = ThreadPoolExecutor(self.frame_threads, thread_name_prefix='frame')
+        self.file_executor = ThreadPoolExecutor(2, thread_name_prefix='file')
+        self.input_executor = InputExecutor(self.log, self.input_pause)
+        self.input_executor.start()
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self._run_loop, args=(loop,))
+        thread.daemon = True
+        thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self._listen(host, port), loop).result()
+        except Exception:
+            loop.call_soon_threadsafe(loop.stop)
+            self._shutdown_executors(self._take_executors())
+            raise
+        self.loop = loop
+        self.running = True
+
+        # Report the pointer separately from the screen frames; it is only polled while a client
+        # streams, see update_cursor_tracking
+        self.cursor_tracker = CursorTracker(self._cursor_changed, self.cursor_interval)
+
+    def stop(self):
+        """Close the listener and every session; returns without waiting for the loop to finish"""
+        self.running = False
+        if self.cursor_tracker:
+            self.cursor_tracker.stop()
+            self.cursor_tracker = None
+        if self.loop:
+            # The shutdown gets this run's listener, tickets and executors, so a start() that
+            # follows before it has run keeps its own
+            tickets, self.tickets = self.tickets, {}
+            asyncio.run_coroutine_threadsafe(self._shutdown(self.server, tickets, self._take_executors()), self.loop)
+            self.loop = None
+            self.server = self.maintenance = None
+
+    def disconnect(self, client_info):
+        """Close one session's connection from any thread"""
+        loop = self.loop
+        if loop:
+            loop.call_soon_threadsafe(client_info['writer'].close)
+
+    def _run_loop(self, loop):
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    async def _listen(self, host, port):
+        self.server = await asyncio.start_server(self.handle_client, host, port, reuse_address=True)
+        self.maintenance = asyncio.create_task(self.maintain_sessions())
+
+    async def _shutdown(self, server, tickets, executors):
+        """Close the listener, end all sessions and stop the loop (runs on the loop being stopped)"""
+        if server:
+            server.close()
+
+        # Everything on this loop belongs to the run being stopped: sessions, their streams,
+        # replies and transfers, connections still authenticating and the maintenance task
+        current = asyncio.current_task()
+        tasks = [task for task in asyncio.all_tasks() if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        tickets.clear()
+        self._shutdown_executors(executors)
+        asyncio.get_running_loop().stop()
+
+    def _take_executors(self):
+        """Detach the current executors from the core, for shutting them down"""
+        executors = (self.executor, self.file_executor, self.input_executor)
+        self.executor = self.file_executor = self.input_executor = None
+        return executors
+
+    def _shutdown_executors(self, executors):
+        executor, file_executor, input_executor = executors
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if file_executor:
+            file_executor.shutdown(wait=False)
+        if input_executor:
+            input_executor.stop()
+
+    async def handle_client(self, reader, writer):
+        """Run one client session, from authentication to disconnect"""
+        addr = writer.get_extra_info('peername')[:2]
+        client_info = {
+            'reader': reader,
+            'writer': writer,
+            'address': addr,
+            'task': asyncio.current_task(),
+            'authenticated': False,
+            'last_activity': datetime.now(),
+            'differ': TileDiffer(),  # Last frame sent, for delta screen updates
+            'keyframe_pending': False,  # The next delta covers the whole screen; cleared under screen_lock
+            'screen_lock': asyncio.Lock(),  # Polled and streamed frames share the differ
+            'messages': None,  # AsyncMessageStream for everything after authentication
+            'streaming': False,
+            'stream_fps': 0,
+            'stream_task': None,
+            'replies': set(),  # Polled screen replies being built, so commands are read meanwhile
+            'controller': None,  # Adapts quality, scale and frame rate while streaming
+            'viewport': None,  # (width, height) the client displays the screen at, if it fits it to a window
+            'frame_id': 0,
+            'frame_format': 'json',  # Negotiated during authentication
+            'session_cipher': None,  # Negotiated during authentication
+            'negotiated': None,  # Capabilities both sides agreed on, see common.Capabilities
+            'lossless_codec': None,  # CODEC_WEBP when negotiated, for lossless tiles; otherwise all JPEG
+            'heartbeat_timeout': None,  # Seconds of silence allowed, for clients that send heartbeats
+            'ticket': None,  # Lets the client resume this session after its connection drops
+            'resume': None,  # (previous session, client's last frame id) while resuming
+            'copy_rects': False,  # Whether the client takes scrolled/moved regions as copy instructions
+            'cursor_sent': None,  # Pointer state last sent with a polled screen reply
+            'transfer_task': None,  # File download running beside the command loop
+            'upload': None,  # File upload whose chunks arrive on the bulk channel
+            'wake': asyncio.Event()  # Set on input, so an idle stream checks the screen right away
+        }
+
+        try:
+            # Authentication
+            try:
+                authenticated = await asyncio.wait_for(self.authenticate_client(client_info), self.auth_timeout)
+            except asyncio.TimeoutError:
+                authenticated = False
+            if not authenticated:
+                self.log(f"Failed authentication attempt from {addr[0]}:{addr[1]}")
+                return
+
+            client_info['authenticated'] = True
+            self.clients.append(client_info)
+            self.on_clients_changed()
+
+            if client_info['resume']:
+                await self.resume_session(client_info, *client_info['resume'])
+                client_info['resume'] = None
+                self.log(f"Client resumed: {addr[0]}:{addr[1]} ({client_info['session_cipher']})")
+            else:
+                self.log(f"Client connected: {addr[0]}:{addr[1]} ({client_info['session_cipher']})")
+
+            # Main communication loop
+            while self.running:
+                try:
+                    message = await client_info['messages'].recv_message()
+                    if message is None:
+                        break
+                    client_info['last_activity'] = datetime.now()
+                    channel, payload = message
+                    if channel == CHANNEL_HEARTBEAT:
+                        continue
+                    if channel == CHANNEL_BULK:
+                        await self.receive_chunk(client_info, payload)
+                    else:
+                        await self.handle_command(client_info, json.loads(payload.decode()))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.log(f"Error handling client {addr[0]}:{addr[1]}: {str(e)}")
+                    break
+
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.log(f"Client error {addr[0]}:{addr[1]}: {str(e)}")
+
+        finally:
+            # Stop any screen stream pushing to this client
+            client_info['streaming'] = False
+            for task in [client_info['stream_task'], client_info['transfer_task']] + list(client_info['replies']):
+                if task and not task.done():
+                    task.cancel()
+            if client_info['upload']:
+                self.run_file_io(client_info['upload']['file'].close)
+
+            writer.close()
+
+            # The session's state stays around for a while in case the client comes back
+            ticket = self.tickets.get(client_info['ticket'])
+            if ticket and ticket['session'] is client_info:
+                ticket['expires'] = time.monotonic() + self.ticket_ttl
+
+            if client_info in self.clients:
+                self.clients.remove(client_info)
+                self.on_clients_changed()
+                self.update_cursor_tracking()
+                self.log(f"Client disconnected: {addr[0]}:{addr[1]}")
+
+    async def handle_command(self, client_info, cmd):
+        """Process one command from an authenticated client"""
+        addr = client_info['address']
+
+        if cmd['action'] == 'screen':
+            # Clients asking for deltas only get the tiles that changed since their last frame;
+            # the reply is built beside the command loop, so input sent meanwhile isn't held up
+            client_info['copy_rects'] = cmd.get('copy', False)
+            reply = asyncio.create_task(self.reply_screen(client_info, cmd.get('delta', False)))
+            client_info['replies'].add(reply)
+            reply.add_done_callback(client_info['replies'].discard)
+        elif cmd['action'] == 'stream':
+            client_info['copy_rects'] = cmd.get('copy', False)
+            self.set_stream(client_info, cmd.get('fps', 0))
+        elif cmd['action'] == 'ack':
+            # Client displayed a streamed frame
+            if client_info['controller']:
+                client_info['controller'].on_ack(cmd['frame_id'])
+        elif cmd['action'] == 'viewport':
+            # Client fits the screen to a window of this size; 0x0 means full resolution
+            width, height = cmd.get('width', 0), cmd.get('height', 0)
+            client_info['viewport'] = (width, height) if width > 0 and height > 0 else None
+        elif cmd['action'] == 'keyframe':
+            # The next delta covers the whole screen; the differ is only reset by build_screen, since
+            # a frame being built meanwhile would overwrite the reset with its own baseline
+            client_info['copy_rects'] = cmd.get('copy', client_info['copy_rects'])
+            client_info['keyframe_pending'] = True
+        elif cmd['action'] == 'mouse':
+            # Not logged per event: every log line is a UI callback, and input arrives hundreds a second
+            self.input_executor.submit([cmd])
+            client_info['wake'].set()
+        elif cmd['action'] == 'keyboard':
+            self.input_executor.submit([cmd])
+            client_info['wake'].set()
+        elif cmd['action'] == 'input_batch':
+            # Coalesced mouse and keyboard events, replayed in order
+            self.input_executor.submit(cmd['events'])
+            client_info['wake'].set()
+        elif cmd['action'] == 'file_download':
+            if client_info['messages'].channels:
+                # Sent beside the command loop, so input keeps flowing during the download
+                await self.start_transfer(client_info, self.send_file(client_info, cmd['path']))
+            else:
+                await self.send_file(client_info, cmd['path'])
+            self.log(f"File download request: {cmd['path']} from {addr[0]}:{addr[1]}")
+        elif cmd['action'] == 'file_upload':
+            await self.receive_file(client_info, cmd['path'], cmd['size'])
+            self.log(f"File upload: {cmd['path']} ({cmd['size']} bytes) from {addr[0]}:{addr[1]}")
+
+    async def authenticate_client(self, client_info):
+        """Authenticate a client connection and negotiate its frame format and message framing"""
+        reader, writer = client_info['reader'], client_info['writer']
+        addr = client_info['address']
+        try:
+            # Receive authentication request; replies go back the way it came
+            auth_data, framed_auth = await self.read_auth_message(reader)
+            def reply(token):
+                writer.write(len(token).to_bytes(4, byteorder='big') + token if framed_auth else token)
+
+            # Decrypt the authentication data
+            try:
+                decrypted = self.cipher.decrypt(auth_data).decode()
+                auth = json.loads(decrypted)
+
+                # A valid ticket resumes a dropped session; the password is sent as well, so an
+                # expired ticket still gets a normal login without another round trip
+                previous = self.take_ticket(auth.get('resume'))
+                if previous is not None:
+                    client_info['resume'] = (previous, auth.get('frame_id'))
+
+                # Check the password
+                if previous is not None or auth.get('password') == self.password:
+                    # Clients that predate the hello are read from their separate fields; they
+                    # keep getting JSON frames, bare tokens and Fernet unless they offered more
+                    negotiated = negotiate_capabilities(
+                        local_capabilities(ENCODABLE_CODECS), auth.get('hello') or legacy_hello(auth)
+                    )
+                    if not auth.get('nonce'):
+                        # A session key needs the client's half of the nonce
+                        negotiated['cipher'] = None
+                    features = negotiated['features']
+                    client_info['negotiated'] = negotiated
+                    client_info['frame_format'] = negotiated['frame_format']
+                    # PNG text tiles are larger than JPEG, so only WebP is used for lossless tiles
+                    client_info['lossless_codec'] = CODEC_WEBP if 'webp' in negotiated['codecs'] else None
+                    framed = negotiated['framing'] == 'length'
+                    channels = 'channels' in features
+                    cipher_name = negotiated['cipher']
+
+                    # Send success response; the legacy fields stay for clients that don't read the hello
+                    response = {'status': 'success', 'frame_format': client_info['frame_format']}
+                    if framed:
+                        response['framing'] = 'length'
+                    if channels:
+                        response['channels'] = True
+
+                    # Clients that send heartbeats get ours and are dropped once theirs stop
+                    if 'heartbeat' in features:
+                        response['heartbeat'] = self.heartbeat_interval
+                        client_info['heartbeat_timeout'] = max(self.heartbeat_timeout, 3 * float(auth.get('heartbeat') or 0))
+
+                    if 'resume' in features:
+                        # A fresh ticket each time, so a ticket can only be used once
+                        client_info['ticket'] = base64.urlsafe_b64encode(os.urandom(24)).decode()
+                        self.tickets[client_info['ticket']] = {'session': client_info, 'expires': None}
+                        response['ticket'] = client_info['ticket']
+                        response['ticket_ttl'] = self.ticket_ttl
+                        if previous is not None:
+                            response['resumed'] = True
+                    if 'input_batch' in features:
+                        response['input_batch'] = True
+                    response['hello'] = negotiated
+                    cipher = self.cipher
+                    if cipher_name:
+                        server_nonce = handshake_nonce()
+                        response['cipher'] = cipher_name
+                        response['nonce'] = base64.b64encode(server_nonce).decode()
+                        key = derive_session_key(self.password, base64.b64decode(auth['nonce']), server_nonce)
+                        cipher = SessionCipher.for_server(cipher_name, key)
+                    reply(self.cipher.encrypt(json.dumps(response).encode()))
+                    await writer.drain()
+
+                    client_info['messages'] = AsyncMessageStream(reader, writer, cipher, framed, channels)
+                    client_info['session_cipher'] = cipher_name or 'fernet'
+                    self.log(f"Negotiated with {addr[0]}:{addr[1]}: {describe(negotiated)}")
+                    return True
+                else:
+                    # Send failure response
+                    response = {'status': 'failed', 'reason': 'Invalid password'}
+                    reply(self.cipher.encrypt(json.dumps(response).encode()))
+                    await writer.drain()
+                    return False
+
+            except Exception as e:
+                # Decryption failed - send error response
+                response = {'status': 'failed', 'reason': 'Authentication error'}
+                try:
+                    # Try to create a new cipher with the received data as if it were a password
+                    # This helps when client uses a different password
+                    temp_key = base64.urlsafe_b64encode(auth_data[:32].ljust(32, b'='))
+                    temp_cipher = Fernet(temp_key)
+                    reply(temp_cipher.encrypt(json.dumps(response).encode()))
+                except:
+                    # If that fails too, just send raw error
+                    reply(json.dumps(response).encode())
+                await writer.drain()
+                return False
+
+        except Exception as e:
+            self.log(f"Authentication error with {addr[0]}:{addr[1]}: {str(e)}")
+            return False
+
+    async def read_auth_message(self, reader):
+        """Read a client's authentication message; returns it and whether it was length-prefixed
+
+        Clients that predate framed authentication send a bare Fernet token in one write, and a
+        token never starts with a zero byte the way a length prefix does.
+        """
+        head = await reader.readexactly(4)
+        if head[0] != 0:
+            return head + await reader.read(4096), False
+        size = int.from_bytes(head, byteorder='big')
+        if size > AUTH_MAX_SIZE:
+            raise ValueError(f"Authentication message of {size} bytes")
+        return await reader.readexactly(size), True
+
+    def take_ticket(self, ticket):
+        """Redeem a resumption ticket; returns the session it belongs to, or None if it is unknown or expired"""
+        entry = self.tickets.pop(ticket, None) if isinstance(ticket, str) else None
+        if entry is None or (entry['expires'] is not None and entry['expires'] < time.monotonic()):
+            return None
+        return entry['session']
+
+    async def resume_session(self, client_info, previous, frame_id):
+        """Carry a dropped session's settings and screen baseline over to its new connection
+
+        The server may not have noticed yet that the old connection is gone, so it is closed
+        here. Deltas continue from the old baseline only if the client has exactly the last
+        frame that was sent; otherwise its next frame is a keyframe.
+        """
+        previous['streaming'] = False
+        if previous in self.clients:
+            previous['messages'].abort()
+
+        # Wait for the old connection's frame work to finish with the differ
+        tasks = [task for task in [previous['stream_task']] + list(previous['replies']) if task and not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if frame_id is not None and frame_id == previous['frame_id']:
+            client_info['differ'] = previous['differ']
+            client_info['keyframe_pending'] = previous['keyframe_pending']
+        client_info['frame_id'] = previous['frame_id']
+        client_info['copy_rects'] = previous['copy_rects']
+        client_info['viewport'] = previous['viewport']
+        client_info['controller'] = previous['controller']
+
+        # Streaming picks up right away, so the client sees the screen within a round trip
+        if previous['stream_fps'] > 0:
+            self.set_stream(client_info, previous['stream_fps'])
+
+    async def maintain_sessions(self):
+        """Send heartbeats, drop sessions whose client has gone silent and forget expired tickets"""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            expired = [ticket for ticket, entry in self.tickets.items()
+                       if entry['expires'] is not None and entry['expires'] < time.monotonic()]
+            for ticket in expired:
+                del self.tickets[ticket]
+
+            now = datetime.now()
+            for client_info in list(self.clients):
+                addr = client_info['address']
+                timeout = client_info['heartbeat_timeout'] or self.session_timeout
+                if (now - client_info['last_activity']).total_seconds() > timeout:
+                    # Nothing queued for a dead peer will ever drain, so don't wait for it
+                    self.log(f"Session timed out: {addr[0]}:{addr[1]}")
+                    client_info['messages'].abort()
+                elif client_info['heartbeat_timeout']:
+                    client_info['messages'].send_heartbeat()
+
+    def set_stream(self, client_info, fps):
+        """Start, retarget or stop pushing screen frames to a client"""
+        addr = client_info['address']
+        client_info['stream_fps'] = fps
+
+        if fps <= 0:
+            client_info['streaming'] = False
+            client_info['wake'].set()
+            self.update_cursor_tracking()
+            self.log(f"Screen stream stopped for {addr[0]}:{addr[1]}")
+            return
+
+        # The requested rate and the UI quality setting are caps the controller adapts under
+        if client_info['controller'] is None:
+            client_info['controller'] = StreamController(fps, self.image_quality, self.latency_target)
+        else:
+            client_info['controller'].set_limits(max_fps=fps)
+
+        client_info['streaming'] = True
+        stream_task = client_info['stream_task']
+        if stream_task is None or stream_task.done():
+            # A new viewer needs to know where the pointer is before it next moves
+            if self.cursor_tracker and self.cursor_tracker.state and 'cursor' in client_info['negotiated']['features']:
+                self.send_message(client_info, dict(type='cursor', **self.cursor_tracker.state))
+
+            client_info['stream_task'] = asyncio.create_task(self.stream_screen(client_info))
+
+        self.update_cursor_tracking()
+        self.log(f"Screen stream at {fps} fps for {addr[0]}:{addr[1]}")
+
+    async def stream_screen(self, client_info):
+        """Push delta screen frames to a client at the rate its controller allows"""
+        messages = client_info['messages']
+        addr = client_info['address']
+        controller = client_info['controller']
+        last_stats = 0.0
+        last_notice = 0.0
+        changed_at = time.time()
+
+        while self.running and client_info['streaming']:
+            start_time = time.time()
+            interval = controller.interval
+            try:
+                # If the client hasn't drained the previous frame yet, skip this tick rather than
+                # queueing a frame that will be stale by the time it is read
+                if not messages.buffered:
+                    # Viewers streaming at similar rates share each other's captures
+                    max_age = 0.5 * controller.interval
+                    scale = self.viewport_scale(client_info) * controller.scale
+                    # An unchanged screen is only reported now and then, so idle streams stay quiet
+                    notify = start_time - last_notice >= self.unchanged_interval
+                    frame_id, size = await self.send_screen(
+                        client_info, True, max_age, quality=controller.quality, scale=scale,
+                        notify_unchanged=notify
+                    )
+                    if frame_id is not None:
+                        controller.on_frame_sent(frame_id, size)
+                        changed_at = start_time
+                    elif size:
+                        last_notice = start_time
+
+                    # Nothing has changed for a while: look less often until something does
+                    if start_time - changed_at >= self.idle_after:
+                        interval = max(interval, self.idle_interval)
+
+                    # Catch up on a pointer change that was skipped while the client was behind
+                    if client_info.get('cursor_pending') and self.cursor_tracker and self.cursor_tracker.state:
+                        client_info['cursor_pending'] = False
+                        self.send_message(client_info, dict(type='cursor', **self.cursor_tracker.state))
+                else:
+                    controller.on_frame_dropped()
+
+                # Let the client show what the controller is doing
+                if start_time - last_stats >= self.stats_interval:
+                    capture_ms = round((self.grabber.avg_capture_time or 0) * 1000, 1)
+                    stats = dict(controller.status(), **self.input_executor.stats())
+                    self.send_message(client_info, dict(type='stream_stats', capture_ms=capture_ms, **stats))
+                    last_stats = start_time
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log(f"Screen stream to {addr[0]}:{addr[1]} ended: {str(e)}")
+                client_info['streaming'] = False
+                self.update_cursor_tracking()
+                break
+
+            # Input from the client wakes an idle stream early, as the screen is likely to change
+            wake = client_info['wake']
+            try:
+                await asyncio.wait_for(wake.wait(), max(0, interval - (time.time() - start_time)))
+                wake.clear()
+                changed_at = time.time()
+            except asyncio.TimeoutError:
+                pass
+
+    def update_cursor_tracking(self):
+        """Poll the pointer only while some client streams with pointer reports (runs on the loop)"""
+        tracker = self.cursor_tracker
+        if tracker is None:
+            return
+        if any(client_info['streaming'] and 'cursor' in client_info['negotiated']['features']
+               for client_info in self.clients):
+            tracker.start()
+        else:
+            tracker.stop()
+
+    def _cursor_changed(self, state):
+        """Hand a pointer change from the tracker thread to the event loop"""
+        loop = self.loop
+        if loop:
+            loop.call_soon_threadsafe(self.broadcast_cursor, state)
+
+    def broadcast_cursor(self, state):
+        """Send a pointer position/shape change to every streaming client"""
+        message = dict(type='cursor', **state)
+        for client_info in list(self.clients):
+            if not client_info['streaming'] or 'cursor' not in client_info['negotiated']['features']:
+                continue
+            try:
+                # Don't queue behind a frame the client hasn't read; its stream sends a skipped state later
+                if not client_info['messages'].buffered:
+                    self.send_message(client_info, message)
+                    client_info['cursor_pending'] = False
+                else:
+                    client_info['cursor_pending'] = True
+            except Exception:
+                # The client's stream notices broken connections
+                pass
+
+    def viewport_scale(self, client_info):
+        """Downscale factor that fits the screen into the client's viewport, never upscaling
+
+        Rounded up to a multiple of 1/32 so viewers with similar windows share scaled frames
+        and the result is never smaller than the viewport.
+        """
+        viewport = client_info['viewport']
+        if not viewport:
+            return 1.0
+
+        # Captured size can differ from the logical screen size on high-DPI displays
+        frame = self.grabber.frame
+        if frame is not None:
+            frame_height, frame_width = frame.shape[:2]
+        else:
+            frame_width, frame_height = self.screen_width, self.screen_height
+        if not frame_width or not frame_height:
+            return 1.0
+
+        fit = min(viewport[0] / frame_width, viewport[1] / frame_height)
+        return min(1.0, math.ceil(fit * 32) / 32)
+
+    async def reply_screen(self, client_info, delta):
+        """Answer a polled screen request, preceded by the pointer state if it moved since the last one"""
+        try:
+            await self.send_polled_cursor(client_info)
+            await self.send_screen(client_info, delta)
+            await client_info['messages'].drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The reader notices the broken connection and ends the session
+            client_info['writer'].close()
+
+    async def send_polled_cursor(self, client_info):
+        """Send a polling client the pointer state if it changed since its last request
+
+        The tracker thread only runs for streaming clients, so this takes a fresh reading.
+        Clients that predate the hello expect exactly one message per request and go without.
+        """
+        negotiated = client_info['negotiated']
+        if not self.cursor_tracker or negotiated['version'] < 1 or 'cursor' not in negotiated['features']:
+            return
+        try:
+            state = await asyncio.get_running_loop().run_in_executor(self.executor, self.cursor_tracker.poll)
+        except Exception:
+            # A failed poll (e.g. a locked desktop) is retried with the next request
+            return
+        if state != client_info['cursor_sent']:
+            client_info['cursor_sent'] = state
+            self.send_message(client_info, dict(type='cursor', **state))
+
+    async def send_screen(self, client_info, delta=False, max_age=None, quality=None, scale=None,
+                          notify_unchanged=True):
+        """Send the screen to a client, as changed tiles only when delta is requested
+
+        The frame is built in the frame executor by build_screen, and the loop only sends it.
+        When a delta client already has the current screen, only a small 'unchanged' message is
+        sent, or nothing at all unless notify_unchanged is set.
+        Returns the client's frame id (None for unchanged or legacy full frames) and the bytes sent.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            async with client_info['screen_lock']:
+                build = loop.run_in_executor(
+                    self.executor, self.build_screen, client_info, delta, max_age, quality, scale
+                )
+                try:
+                    payload, frame_id = await asyncio.shield(build)
+                except asyncio.CancelledError:
+                    # The worker can't be stopped; keep the differ locked until it is done with it
+                    await asyncio.wait([build])
+                    raise
+
+            if payload is None:
+                if not notify_unchanged:
+                    return None, 0
+                return None, self.send_message(client_info, {'type': 'unchanged', 'frame_id': client_info['frame_id']})
+
+            return frame_id, self._send_sized(client_info, payload)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log(f"Error sending screen: {str(e)}")
+            raise
+
+    def build_screen(self, client_info, delta=False, max_age=None, quality=None, scale=None):
+        """Capture and encode a screen message for a client (runs in the frame executor)
+
+        The frame comes from the shared grabber and is only recaptured when older than max_age.
+        Without an explicit scale it is downscaled to the client's viewport before encoding.
+        Returns the payload and its frame id (None for legacy full frames), or (None, None)
+        when a delta client already has the current screen.
+        """
+        # Runs under the client's screen_lock, so nothing else touches the differ meanwhile
+        if client_info['keyframe_pending']:
+            client_info['keyframe_pending'] = False
+            client_info['differ'].reset()
+
+        differ = client_info['differ'] if delta else None
+        if max_age is None:
+            max_age = self.request_max_age
+        if quality is None:
+            quality = self.image_quality
+        if scale is None:
+            scale = self.viewport_scale(client_info)
+
+        # Capture screen
+        frame_id, screenshot_np = self.grabber.grab(max_age, scale)
+
+        frame_height, frame_width = screenshot_np.shape[:2]
+        binary = client_info['frame_format'] == 'binary'
+        copy_rects = client_info['copy_rects'] and 'copy' in client_info['negotiated']['codecs']
+        lossless = self.lossless_tiles and client_info['lossless_codec'] is not None
+
+        if differ is not None:
+            # Delta mode encodes only the tiles whose checksums changed since the client's last frame;
+            # scrolled or moved regions become copies of what the client already has
+            copies, rects = differ.diff(
+                screenshot_np, self.grabber.tile_hashes(frame_id, screenshot_np, scale), copy_rects
+            )
+            if not copies and not rects:
+                return None, None
+
+        if differ is not None or binary:
+            # Binary full frames are sent as strips so they can be encoded in parallel
+            if differ is None:
+                rects = full_frame_rects(frame_width, frame_height)
+                copies = []
+            tiles = [make_tile(rect, COPY_SOURCE.pack(*source), CODEC_COPY) for rect, source in copies]
+            tiles += self.grabber.encode_tiles(
+                frame_id, screenshot_np, rects, quality, scale, lossless, client_info['lossless_codec']
+            )
+            client_info['frame_id'] += 1
+            screen_data = {
+                'width': self.screen_width,
+                'height': self.screen_height,
+                'frame_width': frame_width,
+                'frame_height': frame_height,
+                'frame_id': client_info['frame_id'],
+                'timestamp': time.time(),
+                'tiles': tiles
+            }
+
+            if binary:
+                return pack_frame(screen_data), screen_data['frame_id']
+            screen_data['tiles'] = tiles_to_json(tiles)
+            return json.dumps(screen_data).encode(), screen_data['frame_id']
+
+        # Convert to JPEG with compression
+        full_frame = [(0, 0, frame_width, frame_height)]
+        buffer = self.grabber.encode_tiles(frame_id, screenshot_np, full_frame, quality, scale, lossless=False)[0]['data']
+        jpg_as_text = base64.b64encode(buffer).decode()
+
+        screen_data = {
+            'width': self.screen_width,
+            'height': self.screen_height,
+            'image': jpg_as_text
+        }
+        return json.dumps(screen_data).encode(), None
+
+    def send_message(self, client_info, message):
+        """Send a JSON message on the client's size-prefixed screen channel"""
+        return self._send_sized(client_info, json.dumps(message).encode())
+
+    def _send_sized(self, client_info, payload):
+        """Encrypt a payload and queue it with its 4-byte size header; returns the bytes sent"""
+        # Screen messages were always size-prefixed, even to clients without message framing
+        return client_info['messages'].send(payload, framed=True, channel=CHANNEL_SCREEN)
+
+    def run_file_io(self, func, *args):
+        """Run a blocking file call in the file executor; returns an awaitable future"""
+        return asyncio.get_running_loop().run_in_executor(self.file_executor, func, *args)
+
+    async def send_file(self, client_info, path):
+        """Send file to client, streaming it from disk a block at a time"""
+        messages = client_info['messages']
+        try:
+            # Check if file exists
+            if not await self.run_file_io(os.path.isfile, path):
+                messages.send_json({'error': 'File not found'})
+                return
+
+            file = await self.run_file_io(open, path, 'rb')
+            try:
+                # Send file size
+                size = (await self.run_file_io(os.fstat, file.fileno())).st_size
+                messages.send_json({'size': size})
+
+                # Send file data in chunks, waiting for the client whenever it falls behind; only
+                # one block is held in memory at a time
+                chunk_size = BULK_CHUNK_SIZE if messages.channels else 4096
+                sent = 0
+                while sent < size:
+                    block = await self.run_file_io(file.read, min(FILE_BLOCK_SIZE, size - sent))
+                    if not block:
+                        break
+                    for i in range(0, len(block), chunk_size):
+                        await messages.send_bulk(block[i:i+chunk_size])
+                    sent += len(block)
+            finally:
+                self.run_file_io(file.close)
+
+            self.log(f"File sent: {path} ({sent} bytes)")
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log(f"Error sending file {path}: {str(e)}")
+            # Try to send error message
+            try:
+                messages.send_json({'error': str(e)})
+            except:
+                pass
+
+    async def start_transfer(self, client_info, transfer):
+        """Run a download coroutine as the client's one transfer task"""
+        task = client_info['transfer_task']
+        if (task and not task.done()) or client_info['upload']:
+            transfer.close()
+            client_info['messages'].send_json({'error': 'Another transfer is in progress'})
+            return
+        client_info['transfer_task'] = asyncio.create_task(transfer)
+
+    async def receive_file(self, client_info, path, size):
+        """Receive file from client"""
+        messages = client_info['messages']
+        try:
+            if messages.channels and (client_info['upload'] or (client_info['transfer_task'] and not client_info['transfer_task'].done())):
+                raise RuntimeError("Another transfer is in progress")
+
+            # Create directory if it doesn't exist
+            directory = os.path.dirname(path)
+            if directory:
+                await self.run_file_io(lambda: os.makedirs(directory, exist_ok=True))
+
+            file = await self.run_file_io(open, path, 'wb')
+            if messages.channels:
+                # The data arrives on the bulk channel between other commands; see receive_chunk
+                client_info['upload'] = {'file': file, 'path': path, 'size': size, 'received': 0}
+                if size <= 0:
+                    await self.finish_upload(client_info)
+                return
+
+            # Receive file data
+            try:
+                received = 0
+                while received < size:
+                    chunk = await messages.recv()
+                    if chunk is None:
+                        break
+
+                    await self.run_file_io(file.write, chunk)
+                    received += len(chunk)
+            finally:
+                await self.run_file_io(file.close)
+
+            # Send confirmation
+            messages.send_json({'status': 'success'})
+
+            self.log(f"File received: {path} ({received} bytes)")
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log(f"Error receiving file {path}: {str(e)}")
+            # Try to send error message
+            try:
+                messages.send_json({'status': 'error', 'message': str(e)})
+            except:
+                pass
+
+    async def receive_chunk(self, client_info, chunk):
+        """Write a chunk of the current upload from the bulk channel"""
+        upload = client_info['upload']
+        if upload is None:
+            # Left over from an upload that already failed
+            return
+        try:
+            await self.run_file_io(upload['file'].write, chunk)
+        except Exception as e:
+            await self.finish_upload(client_info, str(e))
+            return
+        upload['received'] += len(chunk)
+        if upload['received'] >= upload['size']:
+            await self.finish_upload(client_info)
+
+    async def finish_upload(self, client_info, error=None):
+        """Close the current upload and confirm it to the client"""
+        upload = client_info['upload']
+        client_info['upload'] = None
+        try:
+            await self.run_file_io(upload['file'].close)
+        except Exception as e:
+            error = error or str(e)
+        if error:
+            self.log(f"Error receiving file {upload['path']}: {error}")
+            client_info['messages'].send_json({'status': 'error', 'message': error})
+        else:
+            client_info['messages'].send_json({'status': 'success'})
+            self.log(f"File received: {upload['path']} ({upload['received']} bytes)")
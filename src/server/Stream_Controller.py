@@ -0,0 +1,151 @@
+import time
+
+# Steps the controller moves through when backing off, cheapest visual cost first
+QUALITY_STEP = 10
+SCALE_STEPS = [1.0, 0.75, 0.5, 0.375, 0.25]
+
+
+class StreamController:
+    """Adapt one client's JPEG quality, resolution scale and frame rate toward a latency target
+
+    The stream thread reports every frame it sends or drops, and the client acknowledges frames
+    as it displays them. Each acknowledgement gives a round-trip sample and the amount of data
+    delivered, from which the controller decides whether to back off or probe upwards.
+    """
+    def __init__(self, max_fps, max_quality, target_latency=0.15, min_fps=2, min_quality=10):
+        self.max_fps = max_fps
+        self.max_quality = max_quality
+        self.min_fps = min(min_fps, max_fps)
+        self.min_quality = min(min_quality, max_quality)
+        self.target_latency = target_latency
+
+        # Current decisions
+        self.fps = max_fps
+        self.quality = max_quality
+        self.scale_index = 0
+
+        # Measurements
+        self.rtt = None  # smoothed round-trip time, seconds
+        self.throughput = None  # smoothed delivered bytes per second
+        self.bytes_sent = 0
+        self.bytes_acked = 0
+        self.dropped = 0
+        self._sent = {}  # frame_id -> (send time, bytes_sent after this frame)
+        self._last_ack_time = None
+        self._last_ack_bytes = 0
+        self._drops_since_update = 0
+        self._last_change = 0.0
+
+    @property
+    def scale(self):
+        return SCALE_STEPS[self.scale_index]
+
+    @property
+    def interval(self):
+        return 1.0 / self.fps
+
+    def set_limits(self, max_fps=None, max_quality=None):
+        """Update the caps, e.g. when the client retargets its stream"""
+        if max_fps is not None:
+            self.max_fps = max_fps
+            self.min_fps = min(self.min_fps, max_fps)
+            self.fps = min(self.fps, max_fps)
+        if max_quality is not None:
+            self.max_quality = max_quality
+            self.min_quality = min(self.min_quality, max_quality)
+            self.quality = min(self.quality, max_quality)
+
+    def on_frame_sent(self, frame_id, size):
+        """Record a frame handed to the socket"""
+        self.bytes_sent += size
+        self._sent[frame_id] = (time.time(), self.bytes_sent)
+
+        # Clients that never acknowledge must not make this grow without bound
+        if len(self._sent) > 256:
+            self._sent.pop(next(iter(self._sent)))
+
+    def on_frame_dropped(self):
+        """Record a tick skipped because the socket had not drained"""
+        self.dropped += 1
+        self._drops_since_update += 1
+
+    def on_ack(self, frame_id):
+        """Take an acknowledgement for a displayed frame and adjust the stream settings"""
+        sent = self._sent.get(frame_id)
+        if sent is None:
+            return
+        now = time.time()
+        sent_time, bytes_after = sent
+
+        # Forget this frame and everything sent before it
+        self._sent = {fid: info for fid, info in self._sent.items() if fid > frame_id}
+
+        sample = now - sent_time
+        self.rtt = sample if self.rtt is None else 0.8 * self.rtt + 0.2 * sample
+
+        if self._last_ack_time is not None and now > self._last_ack_time:
+            rate = (bytes_after - self._last_ack_bytes) / (now - self._last_ack_time)
+            self.throughput = rate if self.throughput is None else 0.8 * self.throughput + 0.2 * rate
+        self._last_ack_time = now
+        self._last_ack_bytes = bytes_after
+        self.bytes_acked = bytes_after
+
+        self._update(now)
+
+    @property
+    def in_flight(self):
+        """Bytes sent but not yet acknowledged"""
+        return self.bytes_sent - self.bytes_acked
+
+    def _update(self, now):
+        """Back off when over the latency target, probe upwards when comfortably under it"""
+        # Give each change at least one round trip to show its effect
+        if now - self._last_change < max(self.rtt, 0.25):
+            return
+
+        backlog = self.throughput is not None and self.in_flight > self.throughput * self.target_latency * 2
+        if self.rtt > self.target_latency or backlog or self._drops_since_update:
+            changed = self._back_off()
+        elif self.rtt < self.target_latency * 0.6:
+            changed = self._probe()
+        else:
+            changed = False
+
+        self._drops_since_update = 0
+        if changed:
+            self._last_change = now
+
+    def _back_off(self):
+        """Lower quality first, then resolution, then frame rate"""
+        if self.quality > self.min_quality:
+            self.quality = max(self.min_quality, self.quality - QUALITY_STEP)
+        elif self.scale_index < len(SCALE_STEPS) - 1:
+            self.scale_index += 1
+        elif self.fps > self.min_fps:
+            self.fps = max(self.min_fps, self.fps * 0.75)
+        else:
+            return False
+        return True
+
+    def _probe(self):
+        """Restore frame rate first, then resolution, then quality"""
+        if self.fps < self.max_fps:
+            self.fps = min(self.max_fps, self.fps * 1.25)
+        elif self.scale_index > 0:
+            self.scale_index -= 1
+        elif self.quality < self.max_quality:
+            self.quality = min(self.max_quality, self.quality + QUALITY_STEP // 2)
+        else:
+            return False
+        return True
+
+    def status(self):
+        """Current decisions and measurements, for display on the client"""
+        return {
+            'quality': self.quality,
+            'scale': self.scale,
+            'fps': round(self.fps, 1),
+            'rtt_ms': round(self.rtt * 1000) if self.rtt is not None else None,
+            'kbps': round(self.throughput * 8 / 1000) if self.throughput is not None else None,
+            'dropped': self.dropped
+        }